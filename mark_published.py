@@ -7,11 +7,20 @@ This script will check that the dataset's status in the Synda database is 'compl
 Similarly, the files in the dataset will be assigned status 'published' if they are already
 'done' or 'staged'."""
 
-import os, sys
-import tarfile, argparse
+import os, sys, time
+import tarfile, argparse, collections
+from multiprocessing.pool import ThreadPool
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir  # backport of os.scandir for Python 2
+    except ImportError:
+        scandir = None
 from pprint import pprint
 import sqlite3, debug
 import logging
+import version_index
 global conn, dryrun
 from retrying import retry
 import pdb
@@ -20,6 +29,10 @@ dryrun = False  # Don't set it to True here.  Instead use the --dryrun argument.
 datasets_already_published = 0
 datasets_not_published_not_marked = 0
 datasets_marked_published = 0
+fs_threads = 8  # threads for listing directories; use the --fs_threads argument to change it.
+fs_stats = { 'files':0, 'listings':0, 'wait':0.0, 'wall':0.0 }
+version_dirs = collections.OrderedDict()  # LRU cache for latest_version_dir()
+version_dirs_max = 4096
 
 def setup(db):
     """Initializes the connection to the database, etc."""
@@ -52,13 +65,27 @@ def mapfile_dates_available( only_after='000000' ):
     dates.sort()
     return dates
 
-def next_suffix():
-    """Returns the next suffix, used to identify the input file mapfile_SUFFIX.tgz and the output
-    file files_not_found_SUFFIX."""
+def read_last_suffix():
+    """Returns the suffix of the last mapfiles file which has been processed."""
     last_suffix_f = '/p/css03/scratch/publishing/CMIP6_last_suffix'
     with open(last_suffix_f,'r') as f:
         last_suffix = f.readline().strip()
-    available_suffixes = mapfile_dates_available( last_suffix )
+    return last_suffix
+
+def save_last_suffix( suffix ):
+    """Records suffix as that of the last mapfiles file which has been processed; unless this is
+    a dry run."""
+    last_suffix_f = '/p/css03/scratch/publishing/CMIP6_last_suffix'
+    if dryrun:
+        logging.info( "Would write %s to %s" % (suffix,last_suffix_f) )
+    else:
+        with open(last_suffix_f,'w') as f:
+            f.write( suffix )
+
+def next_suffix():
+    """Returns the next suffix, used to identify the input file mapfile_SUFFIX.tgz and the output
+    file files_not_found_SUFFIX."""
+    available_suffixes = mapfile_dates_available( read_last_suffix() )
     if len(available_suffixes)>0:
         return available_suffixes[0]
     else:
@@ -139,7 +166,8 @@ def dataset_published( dataset_functional_id, filenotfound ):
     global datasets_already_published, datasets_not_published_not_marked, datasets_marked_published
 
     try:
-        cmd = "SELECT status FROM dataset WHERE dataset_functional_id='%s'" % dataset_functional_id
+        cmd = "SELECT status,path_without_version,version FROM dataset "+\
+              "WHERE dataset_functional_id='%s'" % dataset_functional_id
         curs = conn.cursor()
         curs.execute( cmd )
         results = curs.fetchall()
@@ -157,7 +185,7 @@ def dataset_published( dataset_functional_id, filenotfound ):
         logging.error( "Exception generated in dataset_published due to: "+msg )
         raise Exception( msg )
 
-    status = results[0][0]
+    status, path_without_version, version = results[0]
     #if dryrun:
     #    print "  old status for %s is '%s'" % (dataset_functional_id,status)
     if status=='published':
@@ -185,39 +213,53 @@ def dataset_published( dataset_functional_id, filenotfound ):
                 curs.close()
 
     # For files_published(), we'll need to know whether this is the latest version.
-    try:
-        cmd = "SELECT path_without_version,version FROM dataset WHERE dataset_functional_id='%s'" %\
-              dataset_functional_id
-        curs = conn.cursor()
-        curs.execute( cmd )
-        results = curs.fetchall()
-    except Exception as e:
-        logging.debug( "Exception in dataset_published 3: %s" %e )
-        raise e
-    finally:
-        curs.close()
+    latest_version = version_index.is_latest( conn, path_without_version, version )
 
-    path_without_version = results[0][0]
-    version = results[0][1]
-    try:
-        cmd = "SELECT version FROM dataset WHERE path_without_version='%s'" %\
-              path_without_version
-        curs = conn.cursor()
-        curs.execute( cmd )
-        results = curs.fetchall()
-    except Exception as e:
-        logging.debug( "Exception in dataset_published 4: %s" %e )
-        raise e
-    finally:
-        curs.close()
+    return len(results), latest_version
 
-    versions = [r[0] for r in results]
-    if version==max(versions):
-        latest_version = True
+def file_status_check( file_functional_id, status, local_path, filenotfound, latest_version,
+                       present=None ):
+    """Decides what to do with a file, given its database status and local_path; this is shared
+    by file_published() and mark_published_bulk().  Messages about problems are written to the
+    open file filenotfound.
+    Returns two booleans (successful, publishable).  successful is False if there was a problem,
+    e.g. the file doesn't exist where expected.  publishable is True iff the file's status should
+    now be changed to 'published'.
+    If present is supplied, it is a set of full paths known to exist (see files_present()),
+    and will be used instead of looking at the file system."""
+    if present is None:
+        isfile = os.path.isfile
     else:
-        latest_version = False
+        isfile = present.__contains__
+    if status in ['done,deletesoon','maybe'] or status[0:5]=='error':
+        # Do nothing. (returning False would trigger some output.)
+        return True, False
+        
+    #print "old status for %s is %s" % (file_functional_id,status)
+    if status not in [ 'done', 'staged' ]:
+        if status=='published':
+            return True, False
+        else:
+            # Lots of ways to get here, e.g. retracted data.
+            filenotfound.write( "             Unusual status %s for %s\n" %\
+                                (status,file_functional_id) )
+            return False, False
 
-    return len(results), latest_version
+    # The database says file is 'done' or 'staged'.  It is part of a dataset which
+    # is 'published'.  But make sure that the file is really in the right location to
+    # have been published.  If not, print a message.
+    if latest_version:
+        full_path = '/p/css03/esgf_publish/'+local_path
+        if not isfile(full_path):
+            scratch_path = '/p/css03/scratch/'+local_path
+            filenotfound.write( "Missing file, not at %s\n" % full_path )
+            if isfile(scratch_path):
+                filenotfound.write( "             It is at     %s\n" % scratch_path )
+            else:
+                filenotfound.write( "             not found elsewhere.\n" )
+            return False, False
+
+    return True, True
 
 def file_published( file_functional_id, filenotfound, latest_version ):
     """the file portion of mark_published_synda.
@@ -252,34 +294,11 @@ def file_published( file_functional_id, filenotfound, latest_version ):
         raise Exception(msg)
 
     status = results[0][0]
-    if status in ['done,deletesoon','maybe'] or status[0:5]=='error':
-        # Do nothing. (returning False would trigger some output.)
-        return True
-        
-    #print "old status for %s is %s" % (file_functional_id,status)
-    if status not in [ 'done', 'staged' ]:
-        if status=='published':
-            return True
-        else:
-            # Lots of ways to get here, e.g. retracted data.
-            filenotfound.write( "             Unusual status %s for %s\n" %\
-                                (status,file_functional_id) )
-            return False
-
-    # The database says file is 'done' or 'staged'.  It is part of a dataset which
-    # is 'published'.  But make sure that the file is really in the right location to
-    # have been published.  If not, print a message.
-    if latest_version:
-        local_path = results[0][1]
-        full_path = '/p/css03/esgf_publish/'+local_path
-        if not os.path.isfile(full_path):
-            scratch_path = '/p/css03/scratch/'+local_path
-            filenotfound.write( "Missing file, not at %s\n" % full_path )
-            if os.path.isfile(scratch_path):
-                filenotfound.write( "             It is at     %s\n" % scratch_path )
-            else:
-                filenotfound.write( "             not found elsewhere.\n" )
-            return False
+    local_path = results[0][1]
+    successful, publishable = file_status_check( file_functional_id, status, local_path,
+                                                 filenotfound, latest_version )
+    if not publishable:
+        return successful
 
     # All is well, mark the file as published.
     if not dryrun:
@@ -297,6 +316,233 @@ def file_published( file_functional_id, filenotfound, latest_version ):
     #print "new status for %s is %s" % (file_functional_id,'published')
     return True
 
+# Set-based ("bulk") marking.  Rather than a few SELECTs and an UPDATE+commit for every file,
+# all the dataset_functional_ids of a mapfiles tarball are loaded into a temporary table, the
+# datasets and files are read with a few joins, and the status changes are applied by a few
+# set-based UPDATEs.  The temporary tables belong to this connection only, so loading them
+# doesn't lock out other processes.
+
+def bulk_load_ids( functional_ids ):
+    """Loads dataset_functional_ids into the temporary table pub_ids, for mark_published_bulk()."""
+    global conn
+    try:
+        curs = conn.cursor()
+        curs.execute( "CREATE TEMP TABLE IF NOT EXISTS pub_ids "+
+                      "( dataset_functional_id TEXT PRIMARY KEY )" )
+        curs.execute( "DELETE FROM temp.pub_ids" )
+        curs.executemany( "INSERT OR IGNORE INTO temp.pub_ids VALUES (?)",
+                          [ (fid,) for fid in functional_ids ] )
+        conn.commit()
+    except Exception as e:
+        logging.debug( "Exception in bulk_load_ids: %s" %e )
+        raise e
+    finally:
+        curs.close()
+
+@retry(wait_exponential_multiplier=1000, wait_exponential_max=600000, stop_max_delay=3600000)
+def bulk_read( functional_ids ):
+    """Reads what mark_published_bulk() needs to know about the listed datasets and their files.
+    Returns two dicts.  The first maps a dataset_functional_id to a list of [dataset_id, status,
+    latest_version]; normally there is only one.  The second maps a dataset_id to a list of
+    [file_id, file_functional_id, status, local_path], one for each file of the dataset."""
+    global conn
+    bulk_load_ids( functional_ids )
+    datasets = {}
+    files = {}
+    # latest_version is computed as in dataset_published(), from the version index.
+    cmd = "SELECT d.dataset_functional_id, d.dataset_id, d.status, d.path_without_version, "+\
+          "d.version FROM dataset d JOIN temp.pub_ids p "+\
+          "ON d.dataset_functional_id=p.dataset_functional_id"
+    try:
+        curs = conn.cursor()
+        curs.execute( cmd )
+        for fid, dataset_id, status, path_without_version, version in curs.fetchall():
+            latest = version_index.is_latest( conn, path_without_version, version )
+            datasets.setdefault( fid, [] ).append( [ dataset_id, status, latest ] )
+    except Exception as e:
+        logging.debug( "Exception in bulk_read 1: %s" %e )
+        raise e
+    finally:
+        curs.close()
+    cmd = "SELECT dataset_id, file_id, file_functional_id, status, local_path FROM file "+\
+          "WHERE dataset_id IN (SELECT d.dataset_id FROM dataset d JOIN temp.pub_ids p "+\
+          "ON d.dataset_functional_id=p.dataset_functional_id) ORDER BY dataset_id, file_id"
+    try:
+        curs = conn.cursor()
+        curs.execute( cmd )
+        for dataset_id, file_id, ffid, status, local_path in curs:
+            files.setdefault( dataset_id, [] ).append( [ file_id, ffid, status, local_path ] )
+        conn.commit()  # ends the read transaction, releasing our shared lock
+    except Exception as e:
+        logging.debug( "Exception in bulk_read 2: %s" %e )
+        raise e
+    finally:
+        curs.close()
+    return datasets, files
+
+@retry(wait_exponential_multiplier=1000, wait_exponential_max=600000, stop_max_delay=3600000)
+def bulk_update_chunk( table, ids, old_statuses ):
+    """Changes the status to 'published' for each row of the table ('dataset' or 'file') whose
+    id (dataset_id or file_id) is listed in ids and whose status is one of old_statuses.
+    This is done in one short transaction."""
+    global conn
+    id_column = table+'_id'
+    cmd = "UPDATE %s SET status='published' WHERE %s IN (SELECT id FROM temp.pub_marks) AND "\
+          % (table,id_column) + "status IN (%s)" % ','.join(['?']*len(old_statuses))
+    try:
+        curs = conn.cursor()
+        curs.execute( "CREATE TEMP TABLE IF NOT EXISTS pub_marks ( id INTEGER PRIMARY KEY )" )
+        curs.execute( "DELETE FROM temp.pub_marks" )
+        curs.executemany( "INSERT OR IGNORE INTO temp.pub_marks VALUES (?)",
+                          [ (i,) for i in ids ] )
+        curs.execute( cmd, old_statuses )
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logging.debug( "Exception in bulk_update_chunk: %s" %e )
+        raise e
+    finally:
+        curs.close()
+
+def bulk_update( table, ids, old_statuses, chunksize=20000 ):
+    """Calls bulk_update_chunk() on successive chunks of ids, so that no single transaction
+    holds the write lock for long."""
+    for i in range( 0, len(ids), chunksize ):
+        bulk_update_chunk( table, ids[i:i+chunksize], old_statuses )
+
+# File existence checks for mark_published_bulk().  On a network file system each stat costs
+# milliseconds, so rather than call os.path.isfile() on every file, we list each directory once
+# and fan the listings out over a small pool of threads.
+
+def list_directory( dirpath ):
+    """Lists the directory once.  Returns (dirpath, names, seconds) where names is the set of
+    names of the regular files in dirpath (empty if dirpath can't be read), and seconds is the
+    time spent waiting for the file system."""
+    t0 = time.time()
+    try:
+        if scandir is None:
+            names = set( [ n for n in os.listdir(dirpath)
+                           if os.path.isfile( os.path.join(dirpath,n) ) ] )
+        else:
+            names = set( [ de.name for de in scandir(dirpath) if de.is_file() ] )
+    except OSError:
+        names = set()
+    return dirpath, names, time.time()-t0
+
+def files_present( full_paths, nthreads=None ):
+    """Returns the set of those full_paths which exist as files.  The paths are grouped by
+    directory, and each directory is listed once, by up to nthreads (default fs_threads)
+    threads at a time.  The counts and times are accumulated in fs_stats."""
+    global fs_threads, fs_stats
+    if nthreads is None:
+        nthreads = fs_threads
+    bydir = {}
+    for full_path in full_paths:
+        dirpath, name = os.path.split( full_path )
+        bydir.setdefault( dirpath, [] ).append( (name,full_path) )
+    present = set()
+    if len(bydir)==0:
+        return present
+    t0 = time.time()
+    pool = ThreadPool( max( 1, min( nthreads, len(bydir) ) ) )
+    try:
+        listings = pool.map( list_directory, bydir.keys() )
+    finally:
+        pool.close()
+        pool.join()
+    for dirpath, names, seconds in listings:
+        for name, full_path in bydir[dirpath]:
+            if name in names:
+                present.add( full_path )
+        fs_stats['wait'] += seconds
+    fs_stats['files'] += len(full_paths)
+    fs_stats['listings'] += len(bydir)
+    fs_stats['wall'] += time.time()-t0
+    return present
+
+def bulk_files_present( datasets, files ):
+    """The verification stage of mark_published_bulk().  datasets and files are as returned by
+    bulk_read().  Returns the set of full paths, in esgf_publish or (if not there) scratch, which
+    exist for the files which file_status_check() will need to look for."""
+    global fs_stats
+    wanted = []
+    for drows in datasets.values():
+        for dataset_id, status, latest_version in drows:
+            if not latest_version or status not in [ 'complete', 'staged', 'published' ]:
+                continue
+            wanted += [ frow[3] for frow in files.get( dataset_id, [] )
+                        if frow[2] in [ 'done', 'staged' ] ]
+    present = files_present( [ '/p/css03/esgf_publish/'+local_path for local_path in wanted ] )
+    missing = [ local_path for local_path in wanted
+                if '/p/css03/esgf_publish/'+local_path not in present ]
+    present |= files_present( [ '/p/css03/scratch/'+local_path for local_path in missing ] )
+    logging.info( "verified %s files with %s directory listings (%s stats saved), "
+                  "waited %.1f s on the file system, %.1f s elapsed" %
+                  ( fs_stats['files'], fs_stats['listings'], fs_stats['files']-fs_stats['listings'],
+                    fs_stats['wait'], fs_stats['wall'] ) )
+    return present
+
+def mark_published_bulk( functional_ids, filenotfound ):
+    """Like calling mark_published_synda() on each of the listed dataset_functional_ids, but
+    the database is read with a few queries and written with a few set-based UPDATEs.
+    The counters and the messages written to filenotfound are the same."""
+    global conn, dryrun
+    global datasets_already_published, datasets_not_published_not_marked, datasets_marked_published
+    functional_ids = [ fid for fid in functional_ids if fid is not None ]
+    logging.info( "entering mark_published_bulk for %s datasets" % len(functional_ids) )
+    datasets, files = bulk_read( functional_ids )
+    present = bulk_files_present( datasets, files )
+    mark_datasets = []
+    mark_files = []
+    for dataset_functional_id in functional_ids:
+        # the dataset portion, as in dataset_published():
+        drows = datasets.get( dataset_functional_id, [] )
+        if len(drows)==0:
+            logging.info( "no dataset found matching %s" % dataset_functional_id )
+            continue
+        elif len(drows)>1:
+            msg = "%s datasets found matching %s" % (len(drows),dataset_functional_id )
+            logging.error( "Exception generated in mark_published_bulk due to: "+msg )
+            raise Exception( msg )
+        drow = drows[0]
+        dataset_id, status, latest_version = drow
+        if status=='published':
+            datasets_already_published += 1
+        if status not in [ 'complete', 'staged', 'published' ]:
+            datasets_not_published_not_marked += 1
+            filenotfound.write( "status of %s\t unchanged at '%s'\n" %\
+                                (dataset_functional_id,status) )
+            latest_version = None
+        elif status!='published':
+            datasets_marked_published += 1
+            if dryrun:
+                logging.info( "  changing %s\t from '%s' to 'published'" %
+                              (dataset_functional_id,status) )
+            else:
+                mark_datasets.append( dataset_id )
+                drow[1] = 'published'  # in case the dataset is listed again
+
+        # the file portion, as in file_published():
+        all_successful = True
+        for frow in files.get( dataset_id, [] ):
+            file_id, file_functional_id, fstatus, local_path = frow
+            this_successful, publishable = file_status_check(
+                file_functional_id, fstatus, local_path, filenotfound, latest_version, present )
+            if publishable and not dryrun:
+                mark_files.append( file_id )
+                frow[2] = 'published'
+            all_successful = all_successful and this_successful
+        if not all_successful:
+            # Print a blank line so that the files in filenotfound will be visibly grouped by dataset.
+            filenotfound.write(dataset_functional_id+"\n")
+            filenotfound.write("\n")
+
+    if not dryrun:
+        bulk_update( 'dataset', mark_datasets, ['complete','staged'] )
+        bulk_update( 'file', mark_files, ['done','staged'] )
+    logging.info( "mark_published_bulk marked %s datasets and %s files" %
+                  (len(mark_datasets),len(mark_files)) )
+
 def dataset_namever2functional_id( namever ):
     """Input namever is a dataset name and version number such as
     "cmip5.output1.IPSL.IPSL-CM5A-LR.esmFixClim1.mon.land.Lmon.r1i1p1,v20120526"
@@ -311,12 +557,32 @@ def dataset_namever2functional_id( namever ):
     Output is a Synda dataset_functional_id such as
     "cmip5.output1.IPSL.IPSL-CM5A-LR.esmFixClim1.mon.land.Lmon.r1i1p1.v20120526"
     If the input is already a dataset_functional_id, then it is simply returned."""
+    kind, namever = classify_namever( namever )
+    if kind=='path':
+        namever = path2namever( namever )
+    elif kind!='name':
+        return None
+
+    # This is the place to add further checks or transformations as needed.
+    # E.g. after splitting by ',' and '.', the last substring should start with 'v'.
+    return namever.replace('/','.').replace(',','.').strip()
+
+def classify_namever( namever ):
+    """The string operations of dataset_namever2functional_id() which don't need the file
+    system.  Returns (kind, namever) where kind is one of
+      'runlog' - a mapfile run log, e.g. mapfile_run_1554479110.txt, not a dataset id;
+      'other'  - not a publication mapfile, of no interest to us;
+      'name'   - namever has been reduced to a dataset name and version, e.g.
+                 CMIP6.CMIP.NCAR.CESM2.historical.r2i1p1f1.Emon.cSoil.gn.v20190308 ;
+      'path'   - namever has been reduced to a complete path, whose version directory may be
+                 missing; see path2namever().
+    For 'runlog' and 'other', the namever returned is None."""
     if namever.find('mapfile_run_')>0:
         # mapfile run log, not a dataset id
-        return None
+        return 'runlog', None
     if namever.find('.map')<=0:
         # not a publication mapfile; of no interest to us
-        return None
+        return 'other', None
     else:
         # name of a publication mapfile.  Get rid of everything before the file name, and
         # get rid of the final '.map'
@@ -327,68 +593,232 @@ def dataset_namever2functional_id( namever ):
         namever = namever[27:]
     if namever.count('/')>7:
         # count('/')==8 is a path beginning with CMIP6/ and missing a version.
-        # We'll assume it's a complete path as in this function's docstring; the final
-        # version number is optional though.
+        # We'll assume it's a complete path as in dataset_namever2functional_id's docstring;
+        # the final version number is optional though.
         if namever[0:11]=='p/user_pub/':
             namever = '/'+namever
-        if namever[-9]!='v' or not namever[-8:].isdigit():
-            # We don't have a version number and need one.  Use the latest version.
-            verdirs = [subd for subd in os.listdir(namever) if subd[0]=='v' and
-                       subd[1:].isdigit()]
-            version = max(verdirs)
-            namever = os.path.join( namever, version )
-        namever = os.path.relpath( namever, '/p/css03/esgf_publish')
-    namever = namever.replace('/','.')
+        return 'path', namever
+    return 'name', namever
+
+def path2namever( path ):
+    """Input is a complete path as classified by classify_namever(), possibly missing its
+    version directory.  Returns the path relative to /p/css03/esgf_publish, with the latest
+    version directory appended if it had been missing."""
+    if path[-9]!='v' or not path[-8:].isdigit():
+        # We don't have a version number and need one.  Use the latest version.
+        path = os.path.join( path, latest_version_dir(path) )
+    return os.path.relpath( path, '/p/css03/esgf_publish')
+
+def latest_version_dir( path ):
+    """Returns the name of the latest version subdirectory, vNNNNNNNN, of path.
+    Many mapfiles can point to the same directory, so the results are memoized in version_dirs,
+    a bounded LRU cache: the least recently used entry is dropped when it would exceed
+    version_dirs_max entries."""
+    global version_dirs, version_dirs_max
+    try:
+        version = version_dirs.pop( path )
+    except KeyError:
+        verdirs = [subd for subd in os.listdir(path) if subd[0]=='v' and
+                   subd[1:].isdigit()]
+        version = max(verdirs)
+        if len(version_dirs)>=version_dirs_max:
+            version_dirs.popitem( last=False )
+    version_dirs[path] = version   # now it's the most recently used
+    return version
+
+def resolve_functional_ids( names ):
+    """Batch version of dataset_namever2functional_id().  names is any iterable of names, e.g.
+    the paths of the members of a mapfiles tarball.  This generates the corresponding
+    dataset_functional_ids in order, skipping names (such as mapfile run logs) which don't
+    identify a dataset.  Because it is a generator, marking can begin before all the names have
+    been resolved.  Directory listings for paths without a version are memoized by
+    latest_version_dir()."""
+    counts = { 'runlog':0, 'other':0, 'name':0, 'path':0 }
+    for name in names:
+        kind, namever = classify_namever( name.strip() )
+        counts[kind] += 1
+        if kind=='path':
+            namever = path2namever( namever )
+        elif kind!='name':
+            continue
+        functional_id = namever.replace('/','.').replace(',','.').strip()
+        if functional_id.find('mapfile_run_')==0:
+            continue
+        yield functional_id
+    logging.info( "resolve_functional_ids classified %s" % counts )
+
+def reset_counts():
+    """Sets the dataset counters to zero, e.g. before starting on another mapfiles tarball."""
+    global datasets_already_published, datasets_not_published_not_marked, datasets_marked_published
+    datasets_already_published = 0
+    datasets_not_published_not_marked = 0
+    datasets_marked_published = 0
 
-    # This is the place to add further checks or transformations as needed.
-    # E.g. after splitting by ',' and '.', the last substring should start with 'v'.
-    return namever.replace(',','.').strip()
+def write_counts( filenotfound ):
+    """Logs the dataset counters, and writes them to the open file filenotfound."""
+    global datasets_already_published, datasets_not_published_not_marked, datasets_marked_published
+    writeme = "number of datasets already published = %s" % datasets_already_published
+    logging.info( writeme )
+    filenotfound.write( writeme+'\n' )
+    writeme = "number of datasets in list but shouldn't be = %s" %\
+              datasets_not_published_not_marked
+    logging.info( writeme )
+    filenotfound.write( writeme+'\n' )
+    writeme = "number of datasets just marked as published = %s" %\
+              datasets_marked_published
+    logging.info( writeme )
+    filenotfound.write( writeme+'\n' )
+
+def tarball_functional_ids( listing_file ):
+    """Generates the dataset_functional_ids named by the members of a mapfiles tarball.
+    The tarball is read as a stream, so that the first ids are available before the whole
+    member list has been read."""
+    tf = tarfile.open( listing_file, 'r|*' )
+    try:
+        # Each member is a TarInfo object describing a .map file, with a typical path
+        #   'CMIP6.CMIP.NCAR.CESM2.historical.r2i1p1f1.Emon.cSoil.gn.v20190308.map'
+        # giving the functional_id CMIP6.CMIP.NCAR.CESM2.historical.r2i1p1f1.Emon.cSoil.gn.v20190308
+        for functional_id in resolve_functional_ids( fmap.path for fmap in tf ):
+            yield functional_id
+    finally:
+        tf.close()
+
+def journal_path( suffix ):
+    """Returns the path of the progress journal for the mapfiles file with this suffix."""
+    return "/p/css03/scratch/publishing/mark_published_journal_"+suffix
+
+def read_journal( journal ):
+    """Returns the set of dataset_functional_ids recorded in the progress journal, a file with one
+    dataset_functional_id per line.  If the journal doesn't exist, the set is empty."""
+    if not os.path.isfile( journal ):
+        return set()
+    with open( journal, 'r' ) as f:
+        return set( [ line.strip() for line in f if line.strip()!='' ] )
+
+def remove_journal( journal ):
+    """Removes the progress journal once its mapfiles file has been completely processed, so
+    that a later, deliberate rerun of the same mapfiles file will do everything again."""
+    if journal is None or dryrun or not os.path.isfile( journal ):
+        return
+    os.remove( journal )
+
+def mark_published_tarball( listing_file, filenotfound, bulk=False, handled=None, journal=None ):
+    """Marks the datasets listed in one mapfiles tarball, as described in mark_published_all().
+    The database connection must already be set up; filenotfound is an open file.
+    If handled is supplied, it is a set of dataset_functional_ids which have already been
+    marked earlier in this run.  They will be skipped, and the datasets marked here will be
+    added to the set.
+    If journal is supplied, it is the path of an append-only progress journal.  Each dataset is
+    recorded there once its changes have been committed, and datasets already recorded there
+    (by an earlier run which failed part way through) will be skipped."""
+    global dryrun, conn
+    # Synda may have added versions since the last tarball; the index must know of them.
+    version_index.refresh( conn )
+    journaled = set()
+    jf = None
+    if journal is not None:
+        journaled = read_journal( journal )
+        if len(journaled)>0:
+            logging.info( "resuming; skipping %s datasets recorded in %s" %
+                          (len(journaled),journal) )
+        if not dryrun:
+            jf = open( journal, 'a' )
+    try:
+        functional_ids = []
+        for functional_id in tarball_functional_ids( listing_file ):
+            if handled is not None and functional_id in handled:
+                continue
+            if functional_id in journaled:
+                continue
+            if bulk:
+                functional_ids.append( functional_id )
+                continue
+            try:
+                mark_published_synda( functional_id, filenotfound )
+            except Exception as e:
+                logging.error( "mark_published_all caught an exception from mark_published_synda: %s" %e )
+                raise(e)
+            if handled is not None:
+                handled.add( functional_id )
+            if jf is not None:
+                jf.write( functional_id+'\n' )
+                jf.flush()
+        if bulk:
+            try:
+                mark_published_bulk( functional_ids, filenotfound )
+            except Exception as e:
+                logging.error( "mark_published_all caught an exception from mark_published_bulk: %s" %e )
+                raise(e)
+            if handled is not None:
+                handled.update( functional_ids )
+            if jf is not None:
+                jf.writelines( [ fid+'\n' for fid in functional_ids ] )
+                jf.flush()
+    finally:
+        if jf is not None:
+            jf.close()
 
-def mark_published_all( listing_file, db, filenotfound_nom="files_not_found.txt" ):
+def mark_published_all( listing_file, db, filenotfound_nom="files_not_found.txt", bulk=False,
+                        journal=None ):
     """The input identifies two files.
     The first file lists datasets which are published, one per line.
     The second file is a Synda database.
     In the database, each listed dataset will get status 'published' if it already has
     status 'complete' or 'staged'.  Similarly, each file of the dataset will get status
-    'published' if its status is 'done' or 'staged'."""
-    global datasets_already_published, datasets_not_published_not_marked, datasets_marked_published
+    'published' if its status is 'done' or 'staged'.
+    If bulk is True, all the datasets are marked together by mark_published_bulk(), rather
+    than one at a time by mark_published_synda().
+    If journal is supplied, it is the path of a progress journal; see mark_published_tarball().
+    It is removed when all datasets have been processed."""
     try:
         setup(db)
         filenotfound = open( filenotfound_nom, 'a' )
-        tf = tarfile.open( listing_file )
-        files = tf.getmembers()
-        for fmap in files:
-            # fmap is a TarInfo object describing a .map file
-            fp = fmap.path
-            # typical fp = 'CMIP6.CMIP.NCAR.CESM2.historical.r2i1p1f1.Emon.cSoil.gn.v20190308.map'
-            functional_id = dataset_namever2functional_id( fp.strip() )
-            # ... e.g. CMIP6.CMIP.NCAR.CESM2.historical.r2i1p1f1.Emon.cSoil.gn.v20190308
-            if functional_id is None or functional_id.find('mapfile_run_')==0:
-                # e.g. mapfile_run_1554479110.txt; it's just a mapfile run log
-                continue
-            try:
-                mark_published_synda( functional_id, filenotfound )
-            except Exception as e:
-                logging.error( "mark_published_all caught an exception from mark_published_synda: %s" %e )
-                raise(e)
+        mark_published_tarball( listing_file, filenotfound, bulk, journal=journal )
+        remove_journal( journal )
     except Exception as e:
         logging.error( "Exception caught in mark_published_all: %s" % e )
         raise(e)
     finally:
-        writeme = "number of datasets already published = %s" % datasets_already_published
-        logging.info( writeme )
-        filenotfound.write( writeme+'\n' )
-        writeme = "number of datasets in list but shouldn't be = %s" %\
-                  datasets_not_published_not_marked
-        logging.info( writeme )
-        filenotfound.write( writeme+'\n' )
-        writeme = "number of datasets just marked as published = %s" %\
-                  datasets_marked_published
-        logging.info( writeme )
-        filenotfound.write( writeme+'\n' )
+        write_counts( filenotfound )
         filenotfound.close()
         finish()
 
+def mark_published_catchup( db, bulk=False, use_journal=True ):
+    """Catch-up mode, e.g. after an outage.  Every mapfiles tarball after the last suffix is
+    processed, in date order, over a single database connection.  A dataset which appears in
+    more than one tarball is marked only the first time.  Each tarball's files_not_found file
+    gets its own counts, and the last suffix is advanced as soon as each tarball has been
+    committed, so a failure means that only the failed tarball and its successors are retried.
+    If use_journal is True, each tarball has a progress journal; see mark_published_tarball()."""
+    suffixes = mapfile_dates_available( read_last_suffix() )
+    if len(suffixes)==0:
+        logging.info( "Nothing for mark_published_catchup() to do, all mapfiles have already been read." )
+        return
+    logging.info( "catching up on suffixes %s" % suffixes )
+    handled = set()
+    try:
+        setup(db)
+        for suffix in suffixes:
+            logging.info( "suffix = %s" % suffix )
+            listing_file = "/p/user_pub/publish-queue/CMIP6-map-tarballs/mapfiles-" +\
+                           suffix + ".tgz"
+            filenotfound = open( "/p/css03/scratch/logs/files_not_found_"+suffix, 'a' )
+            journal = journal_path( suffix ) if use_journal else None
+            reset_counts()
+            try:
+                mark_published_tarball( listing_file, filenotfound, bulk, handled, journal )
+                conn.commit()
+            finally:
+                write_counts( filenotfound )
+                filenotfound.close()
+            save_last_suffix( suffix )
+            remove_journal( journal )
+    except Exception as e:
+        logging.error( "Exception caught in mark_published_catchup: %s" % e )
+        raise(e)
+    finally:
+        finish()
+
 if __name__ == '__main__':
     logfile = '/p/css03/scratch/logs/mark_published.log'
     # Set level to logging.DEBUG to get logs of all database exceptions.
@@ -401,6 +831,18 @@ if __name__ == '__main__':
 
     # keyword arguments, all optional and useful only for testing:
     p.add_argument( "--dryrun", required=False, action="store_true" )
+    p.add_argument( "--bulk", required=False, action="store_true",
+                    help="mark all datasets of the mapfiles file together, with a few set-based "+\
+                    "database updates rather than one update per file" )
+    p.add_argument( "--fs_threads", required=False, type=int, default=8,
+                    help="with --bulk, the number of threads listing directories to check "+\
+                    "that files exist" )
+    p.add_argument( "--catchup", required=False, action="store_true",
+                    help="process every mapfiles file after the last suffix, in date order; "+\
+                    "--suffix, --published_datasets and --files_not_found are ignored" )
+    p.add_argument( "--no_journal", required=False, action="store_true",
+                    help="don't keep a progress journal, so a rerun after a failure will start "+\
+                    "over from the first dataset" )
     p.add_argument( "--suffix", required=False,
                     help="suffix of mapfiles file in /p/user_pub/publish_queue/CMIP6-map-tarballs"+\
                     "e.g. 190418 is the suffix of mapfiles-190418.tgz",
@@ -415,19 +857,30 @@ if __name__ == '__main__':
 
     args = p.parse_args( sys.argv[1:] )
 
-    if args.suffix is None:
-        suffix = next_suffix()
-    else:
-        suffix = args.suffix
-    logging.info( "suffix = %s" % suffix )
-
     if args.dryrun==True:
         dryrun = True
     logging.info( "dryrun = %s" % dryrun )
+    fs_threads = args.fs_threads
     #if not dryrun:
     #    print "Hey, I'm testing!  Run with --dryrun"
     #    sys.exit()
 
+    if args.catchup:
+        try:
+            mark_published_catchup( args.database, bulk=args.bulk,
+                                    use_journal=(not args.no_journal) )
+        except:
+            # The exception should have been logged already; quit.  The last suffix has been
+            # saved for each tarball which was completed.
+            sys.exit(1)
+        sys.exit()
+
+    if args.suffix is None:
+        suffix = next_suffix()
+    else:
+        suffix = args.suffix
+    logging.info( "suffix = %s" % suffix )
+
     published_datasets = args.published_datasets
     if published_datasets is None:
         published_datasets = "/p/user_pub/publish-queue/CMIP6-map-tarballs/mapfiles-" +\
@@ -437,18 +890,20 @@ if __name__ == '__main__':
     if files_not_found is None:
         files_not_found = "/p/css03/scratch/logs/files_not_found_"+suffix
 
+    if args.no_journal:
+        journal = None
+    else:
+        journal = journal_path( suffix )
+
     try:
-        mark_published_all( published_datasets, args.database, files_not_found )
+        mark_published_all( published_datasets, args.database, files_not_found, bulk=args.bulk,
+                            journal=journal )
     except:
         # The exception should have been logged already; quit.  The file
         # last_suffix_f won't be updated, so the same mapfiles will be retried
-        # the next time this script is run.
+        # the next time this script is run.  The journal records which datasets are done,
+        # so the retry will resume where this run failed.
         sys.exit(1)
 
     if args.suffix is None:
-        last_suffix_f = '/p/css03/scratch/publishing/CMIP6_last_suffix'
-        if dryrun:
-            logging.info( "Would write %s to %s" % (suffix,last_suffix_f) )
-        else:
-            with open(last_suffix_f,'w') as f:
-                f.write( suffix )
+        save_last_suffix( suffix )
@@ -2,23 +2,34 @@
 
 """Checks the error_history field of each file for whether it records file-specific errors which had
 been repeated over an extended period of time.  Such files' statuses will be changed will be changed
-from 'error' to 'error-badurl' or 'error-checksum'"""
+from 'error' to 'error-badurl' or 'error-checksum'.
+Other rules for permanent errors may be supplied in a file, see read_rules()."""
 
-import sys, pdb
+import sys, pdb, re, ast
 import argparse, logging
+import functools, itertools, multiprocessing, zlib
 import sqlite3
 import debug
 from dateutil.parser import parse
 import datetime
 global conn, curs
 
-def setup( db='/var/lib/synda/sdt/sdt.db' ):
-    """Initializes the connection to the database, etc."""
+def setup( db='/var/lib/synda/sdt/sdt.db',
+           scan_db='/p/css03/scratch/publishing/permanent_error_scan.db' ):
+    """Initializes the connection to the database, etc.
+    The side database scan_db is attached as 'scan'.  Its table 'evaluated' records, for each
+    file_id, a fingerprint of the error_history which was last evaluated; so a later run need
+    only evaluate new or changed error histories.  It is kept out of the Synda database so that
+    writing to it doesn't lock the Synda database."""
     # To test on a temporary copy of the database:
     #db = '/home/painter/db/sdt.db'
     global conn, curs
     conn = sqlite3.connect(db)
     curs = conn.cursor()
+    curs.execute( "ATTACH DATABASE ? AS scan", (scan_db,) )
+    curs.execute( "CREATE TABLE IF NOT EXISTS scan.evaluated "+
+                  "( file_id INTEGER PRIMARY KEY, fingerprint TEXT )" )
+    conn.commit()
 
 def finish():
     """Closes connections to databases, etc."""
@@ -44,43 +55,152 @@ def confirm_yesnoquit():
     else:
         sys.stdout.write("Please respond with 'yes', 'no', or 'quit'")
 
+# error_history is stored as the repr of a list of (date,error) tuples, e.g.
+#   [('2020-06-09 10:49:35.255064', 'ERROR 404'), ('2020-06-09 13:47:21.039614', 'ERROR 404')]
+# It used to be decoded with eval(), which is unsafe and slow, and its dates were parsed again
+# and again with dateutil.  decode_error_history() is a dedicated decoder for this format.
+history_item = re.compile( r"""\(\s*u?(['"])(.*?)\1\s*,\s*u?(['"])(.*?)\3\s*\)""" )
+
+def parse_time( date ):
+    """Converts a date string to a datetime object.  The usual 'YYYY-MM-DD HH:MM:SS.ffffff' and
+    'YYYY-MM-DD HH:MM:SS' formats are converted by slicing; anything else goes to dateutil."""
+    if ( len(date)==26 or len(date)==19 ) and date[4]=='-' and date[7]=='-' and\
+       date[13]==':' and date[16]==':':
+        try:
+            return datetime.datetime( int(date[0:4]), int(date[5:7]), int(date[8:10]),
+                                      int(date[11:13]), int(date[14:16]), int(date[17:19]),
+                                      int(date[20:26]) if len(date)==26 else 0 )
+        except ValueError:
+            pass
+    return parse(date)
+
+def decode_error_history( text ):
+    """Decodes an error_history string from the database into a list of 2-tuples (date,error),
+    where date is a datetime object; each date is parsed exactly once.
+    Anything which the fast decoder doesn't fully understand is decoded by ast.literal_eval(),
+    which is safe, unlike eval()."""
+    matches = history_item.findall( text )
+    if text.find('\\')<0 and len(matches)==text.count('), (')+1:
+        items = [ (m[1], m[3]) for m in matches ]
+    else:
+        items = ast.literal_eval( text )
+    return [ ( parse_time(date), error ) for (date,error) in items ]
+
+# Rules for permanent errors.  A rule is a dict with these keys:
+#   pattern      - an error matches the rule if it contains this string, e.g. 'ERROR 404'
+#   min_interval - minimum interval, in days, between errors for both to be counted
+#   min_errors   - minimum number of such errors for the file to get the new status
+#   window       - if not None, only errors within this many days of the present count
+#   status       - the new status, e.g. 'error-badurl'
+# The rules are tried in order; the first one satisfied decides the new status.
+
+def make_rule( pattern, min_interval=5, min_errors=3, window=None, status='error-badurl' ):
+    """Returns a rule for apply_rules()."""
+    return { 'pattern':pattern, 'min_interval':min_interval, 'min_errors':min_errors,
+             'window':window, 'status':status }
+
+def default_rules( min_interval=5, nrepeats=3 ):
+    """The standard rules: repeated 'ERROR 404' errors make 'error-badurl', and repeated
+    'bad checksum' errors make 'error-checksum'."""
+    return [ make_rule( 'ERROR 404', min_interval, nrepeats, None, 'error-badurl' ),
+             make_rule( 'bad checksum', min_interval, nrepeats, None, 'error-checksum' ) ]
+
+def read_rules( rules_file ):
+    """Reads rules from a text file.  Each line is of the form
+      pattern|min_interval|min_errors|window|status
+    e.g.  Connection refused|2|5|30|error-refused
+    The window may be empty, meaning no limit.  Blank lines and lines beginning with # are
+    ignored."""
+    rules = []
+    with open( rules_file, 'r' ) as f:
+        for line in f:
+            line = line.strip()
+            if line=='' or line[0]=='#':
+                continue
+            pattern, min_interval, min_errors, window, status = line.split('|')
+            rules.append( make_rule( pattern, float(min_interval), int(min_errors),
+                                     float(window) if window.strip()!='' else None,
+                                     status.strip() ) )
+    return rules
+
+def apply_rules( error_history, rules, now=None ):
+    """Evaluates all the rules in one pass over error_history, a list of 2-tuples (date,error)
+    with dates as datetime objects, e.g. from decode_error_history().
+    Returns the index in rules of the first rule which is satisfied, or None."""
+    nrules = len(rules)
+    if nrules==0 or len(error_history)<min( [ r['min_errors'] for r in rules ] ):
+        return None
+    if now is None:
+        now = datetime.datetime.now()
+    earliest = [ now-datetime.timedelta(days=r['window']) if r['window'] is not None else None
+                 for r in rules ]
+    nerrors = [0]*nrules
+    date_last_error = [None]*nrules
+    for date, error in sorted( error_history ):
+        for i in range(nrules):
+            if error.find( rules[i]['pattern'] )<0:
+                continue
+            if earliest[i] is not None and date<earliest[i]:
+                continue
+            # Converting to totalseconds lets us support fractional days.
+            if date_last_error[i] is None or\
+               (date-date_last_error[i]).total_seconds()/3600./24>=rules[i]['min_interval']:
+                # date is at least min_interval days after the previous counted error date.
+                nerrors[i] += 1
+                date_last_error[i] = date
+    for i in range(nrules):
+        if nerrors[i]>=rules[i]['min_errors']:
+            return i
+    return None
+
 def tobe_permanent( error_history, error_in='ERROR 404', min_interval=5, min_errors=3 ):
     """If the error_history records repeated errors, that call for changing a file's status
     to a permanent error, return the new status.   Otherwise return None.
     error_history should be a list of 2-tuples (date,error).  The input error to check
-    for should be supplied.  Presently (and probably forever) if must be one of
-    "bad checksum" or "ERROR 404".
+    for should be supplied.  It must be one of "bad checksum" or "ERROR 404"; for other errors,
+    use apply_rules().
     The minimum interval between errors may be supplied, and defaults to 5.
     The minimum number of errors may be supplied, and defaults to 3."""
-    if len(error_history)<min_errors:
-        return None
     return_error = { 'ERROR 404':'error-badurl', 'bad checksum':'error-checksum' }
     assert error_in in return_error
-    dates = [ e[0] for e in error_history if e[1]==error_in ]
-    if len(dates)<min_errors:
+    # The dates may be datetime objects, as from decode_error_history(), or strings.
+    error_history = [ ( e[0] if isinstance(e[0],datetime.datetime) else parse_time(e[0]), e[1] )
+                      for e in error_history ]
+    rule = make_rule( error_in, min_interval, min_errors, None, return_error[error_in] )
+    if apply_rules( error_history, [rule] ) is None:
         return None
-    date_last_error = parse(dates[0])
-    nerrors = 1
-    dates.sort()
-    for i in range(1,len(dates)):
-        # Get the time since the last error.
-        # Converting to totalseconds lets us support fractional days.
-        interval = (parse(dates[i])- date_last_error).total_seconds()/3600./24
-        if interval>=min_interval:
-            # dates[i] is at least min_interval days after the previous error date.
-            nerrors += 1
-            date_last_error = parse(dates[i])
-    if nerrors>=min_errors:
-        return return_error[error_in]
     else:
-        return None
+        return return_error[error_in]
 
-def mark_permanent_errors( min_interval=5, nrepeats=3, dryrun=True, confirm=True ):
+def classify_row( row, rules ):
+    """Decides the new status for one row (file_id, filename, error_history) of the file table.
+    Returns (file_id, filename, irule, error_history) where irule is the index of the rule
+    which gives the new status, or None if the status shouldn't change.
+    This is a module-level function so that a process pool can run it."""
+    file_id, filename, history_text = row
+    irule = apply_rules( decode_error_history( history_text ), rules )
+    return file_id, filename, irule, history_text
+
+def history_fingerprint( error_history, rules_key ):
+    """Returns a short fingerprint of an error_history string, and of the rules it was
+    evaluated with (rules_key); so that if either changes, it will be evaluated again."""
+    if isinstance( error_history, unicode ):
+        error_history = error_history.encode('utf-8')
+    return "%s:%08x:%s" % ( len(error_history), zlib.crc32(error_history) & 0xffffffff, rules_key )
+
+def mark_permanent_errors( min_interval=5, nrepeats=3, dryrun=True, confirm=True, processes=1,
+                           incremental=True, rules=None ):
     """Check the database for files with 'error' status, whose error_history represents
     repeated errors, either 'ERROR 404' or 'bad checksum'.  For each such file, change its status
     to a permanent one (not affected by "synda retry"):  'error-badurl' or 'error-checksum'.
     The minimum interval between errors may be supplied, and defaults to 5.
     The minimum number of repeated errors may be supplied, and defaults to 3.
+    Or other rules may be supplied, see make_rule(); then min_interval and nrepeats are ignored.
+    A summary of how many files each rule moved (or would move) is logged and printed.
+    If processes>1, the error histories will be decoded and checked by that many processes.
+    If incremental is True, only error histories which have changed since they were last
+    evaluated (see setup()) will be evaluated.
+    The status changes are made together, in one short transaction at the end.
     """
     global conn, curs
     # At present, the shortest possible non-null error string is 45 characters:
@@ -88,20 +208,41 @@ def mark_permanent_errors( min_interval=5, nrepeats=3, dryrun=True, confirm=True
     # The shortest possible one with two errors recorded is 90 characters:
     #  [('2020-06-09 10:49:35.255064', 'ERROR 404'), ('2020-06-09 13:47:21.039614', 'ERROR 404')]
     # So if we want three errors we only need look at strings with >=45*nrepeats characters.
-    cmd = "SELECT file_id, filename, error_history FROM file WHERE " +\
-          "status='error' AND error_history IS NOT NULL AND LENGTH(error_history)>=?"
+    if rules is None:
+        rules = default_rules( min_interval, nrepeats )
+    nrepeats = min( [ r['min_errors'] for r in rules ] )
+    rules_key = "%08x" % ( zlib.crc32( repr( [ sorted(r.items()) for r in rules ] ) ) & 0xffffffff )
+    fingerprint = functools.partial( history_fingerprint, rules_key=rules_key )
+    if incremental:
+        conn.create_function( "history_fingerprint", 1, fingerprint )
+        cmd = "SELECT f.file_id, f.filename, f.error_history FROM file f " +\
+              "LEFT JOIN scan.evaluated e ON f.file_id=e.file_id WHERE " +\
+              "f.status='error' AND f.error_history IS NOT NULL AND " +\
+              "LENGTH(f.error_history)>=? AND " +\
+              "(e.fingerprint IS NULL OR e.fingerprint!=history_fingerprint(f.error_history))"
+    else:
+        cmd = "SELECT file_id, filename, error_history FROM file WHERE " +\
+              "status='error' AND error_history IS NOT NULL AND LENGTH(error_history)>=?"
     curs.execute( cmd, (45*nrepeats,) )
     results = curs.fetchall()
-    for result in results:
-        if result is None:
-            break
-        file_id = result[0]
-        filename = result[1]
-        error_history = eval(result[2])
-        new_status = tobe_permanent(error_history,'ERROR 404',min_interval,nrepeats)
-        if new_status is None:
-            new_status = tobe_permanent(error_history,'bad checksum',min_interval,nrepeats)
-        if new_status is not None:
+    conn.commit()   # ends the read transaction
+    logging.info( "%s error histories to evaluate" % len(results) )
+    changes = []       # (new_status, file_id)
+    evaluated = []     # (file_id, fingerprint)
+    nmoved = [0]*len(rules)
+    classify = functools.partial( classify_row, rules=rules )
+    if processes>1:
+        # For very large error sets, decode and classify in a pool of processes.
+        pool = multiprocessing.Pool( processes )
+        classified = pool.imap( classify, results, chunksize=1000 )
+    else:
+        pool = None
+        classified = itertools.imap( classify, results )
+    for file_id, filename, irule, error_history in classified:
+        evaluated.append( ( file_id, fingerprint(error_history) ) )
+        if irule is not None:
+            new_status = rules[irule]['status']
+            nmoved[irule] += 1
             if dryrun:
                 # print, don't log.  This is a debugging mode.
                 print "file %s is ready for permanent error status as %s"%(filename,new_status)
@@ -112,23 +253,41 @@ def mark_permanent_errors( min_interval=5, nrepeats=3, dryrun=True, confirm=True
                 print "change %s from status 'error' to '%s'?"%(filename,new_status)
                 yesnoquit = confirm_yesnoquit()
                 if yesnoquit==True:
-                    cmd = "UPDATE file SET status=? WHERE file_id=?"
-                    cmd_vars = ( new_status, file_id )
-                    curs.execute( cmd, cmd_vars )
+                    changes.append( ( new_status, file_id ) )
                     print "changed status to '%s'" % new_status
                     logging.info( "changed status of %s to '%s'" % (filename, new_status) )
                 elif yesnoquit==False:
                     print "leaving status at 'error'"
                 else:
                     print "leaving status at 'error' for this and subsequent files"
+                    evaluated.pop()   # not really evaluated; nor are the files after it
                     break
             else:
                 # Change the error status, without asking for confirmation.
                 # A filename may have multiple versions, but it's more understandable than file_id.
-                cmd = "UPDATE file SET status=? WHERE file_id=?"
-                cmd_vars = ( new_status, file_id )
-                curs.execute( cmd, cmd_vars )
+                changes.append( ( new_status, file_id ) )
                 logging.info( "changed status of %s to '%s'" % (filename, new_status) )
+    if pool is not None:
+        pool.terminate()  # needed if we broke out of the loop early
+        pool.join()
+    for i in range(len(rules)):
+        summary = "rule '%s' (%s errors, %s days apart) -> '%s': %s files" %\
+                  ( rules[i]['pattern'], rules[i]['min_errors'], rules[i]['min_interval'],
+                    rules[i]['status'], nmoved[i] )
+        logging.info( summary )
+        if dryrun:
+            print summary
+    if dryrun:
+        return
+    # Record the fingerprints first: that locks only the side database.  Then make all the
+    # status changes at once, so the Synda database is locked only briefly.  The status
+    # condition protects any file whose status has been changed since we read it.
+    curs.executemany( "INSERT OR REPLACE INTO scan.evaluated (file_id,fingerprint) VALUES (?,?)",
+                      evaluated )
+    curs.executemany( "UPDATE file SET status=? WHERE file_id=? AND status='error'", changes )
+    conn.commit()
+    logging.info( "evaluated %s error histories, changed the status of %s files" %
+                  ( len(evaluated), len(changes) ) )
 
 if __name__ == '__main__':
     # Set up logging and arguments, then call the appropriate 'run' function.
@@ -142,6 +301,14 @@ if __name__ == '__main__':
                     "minimum interval between errors for both to be considered; in days." )
     p.add_argument( "--nrepeats", dest="nrepeats", required=False, type=int, default=3, help=
                     "number of repeated errors to change the error to a permanent one." )
+    p.add_argument( "--processes", dest="processes", required=False, type=int, default=1, help=
+                    "number of processes decoding error histories; >1 is useful for very "+
+                    "large numbers of errors." )
+    p.add_argument( "--rules", dest="rules", required=False, default=None, help=
+                    "file of rules, one per line: pattern|min_interval|min_errors|window|status ."+
+                    "  If supplied, --interval and --nrepeats are ignored." )
+    p.add_argument( "--full", dest="incremental", action="store_false", default=True, help=
+                    "evaluate every error history, not just new or changed ones." )
     p.add_argument('--dryrun', dest='dryrun', action='store_true' )
     p.add_argument('--no-dryrun', dest='dryrun', action='store_false' )
     p.add_argument('--confirm', dest='confirm', action='store_true', default=False )
@@ -153,6 +320,8 @@ if __name__ == '__main__':
     setup()
     logging.info( "started permanent_error_status, args=%s"%args )
     mark_permanent_errors( args.interval, args.nrepeats, dryrun=args.dryrun,
-                           confirm=args.confirm )
+                           confirm=args.confirm, processes=args.processes,
+                           incremental=args.incremental,
+                           rules=(None if args.rules is None else read_rules(args.rules)) )
     finish()
 
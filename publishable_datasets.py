@@ -18,17 +18,33 @@ previous run); in which case the ending time is not updated, of course.
 Paths, group names, etc. are hard-wired.  This is *not* a general-purpose script!
 """
 
-import os, sys, datetime, shutil, stat, argparse
+import os, sys, datetime, shutil, stat, argparse, errno, time
 import socket, pwd, grp
+import threading
+from multiprocessing.pool import ThreadPool
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir  # backport of os.scandir for Python 2
+    except ImportError:
+        scandir = None
 from pprint import pprint
 import sqlite3
 import logging
 import pdb, debug
-global conn, curs, dryrun, std_file_perms, std_dir_perms
+global conn, curs, dryrun, std_file_perms, std_dir_perms, move_workers, fs_limit, copy_threads
 
 dryrun = False
+move_workers = 8  # number of datasets moved at once; use the --workers argument to change it.
+fs_limit = 4      # maximum concurrent moves into one file system; see the --fs_limit argument.
+copy_threads = 4  # threads copying files of one dataset, for a move between file systems.
+copy_chunk = 16*1024*1024  # bytes per read and write when copying a file
 std_file_perms = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IROTH 
 std_dir_perms = std_file_perms | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+perm_stats = { 'checked':0, 'calls':0, 'saved':0 }  # see chgrp_perms_updown()
+parents_done = set()   # parent directories whose group and permissions have been normalized
+perm_lock = threading.Lock()
 
 def setup(db):
     """Initializes the connection to the database, etc."""
@@ -61,28 +77,152 @@ def chgrp_perms( path, group='climatew', permissions=None ):
     os.chown( path, -1, _group )
     os.chmod( path, permissions )
 
+def normalize_perms( path, st, gid, permissions ):
+    """Changes the group and permissions of path to gid and permissions, but only where they
+    differ from those in st, a stat result for path.  Returns the number of chown and chmod
+    calls made, at most 2."""
+    ncalls = 0
+    if gid!=-1 and st.st_gid!=gid:
+        os.chown( path, -1, gid )
+        ncalls += 1
+    if stat.S_IMODE(st.st_mode)!=permissions:
+        os.chmod( path, permissions )
+        ncalls += 1
+    return ncalls
+
 def chgrp_perms_updown( path, group='climatew' ):
     """Changes the group of the path, its parents (below /css03/esgf_publish or equivalent) and
-    children.  Also changes their permissions to std_file_perms or std_dir_perms."""
-    global std_file_perms, std_dir_perms
+    children.  Also changes their permissions to std_file_perms or std_dir_perms.
+    This is change-aware: an entry whose group and permissions are already right isn't touched,
+    and a parent directory is done only once per run (parents_done), however many datasets
+    share it.  Counts are accumulated in perm_stats."""
+    global std_file_perms, std_dir_perms, perm_stats, parents_done, perm_lock
+    if group is None:
+        gid = -1 # means don't change the group
+    elif isinstance(group, int):
+        gid = group
+    else:
+        gid = grp.getgrnam(group)[2]
+    nchecked = 0
+    ncalls = 0
+    nparents_skipped = 0
     # First go down
-    for (root,dirs,files) in os.walk(path):
-        chgrp_perms( root, group, std_dir_perms )
-        for file in files:
-            chgrp_perms( os.path.join(root,file), group, std_file_perms )
-    dir = path
+    ncalls += normalize_perms( path, os.stat(path), gid, std_dir_perms )
+    nchecked += 1
+    dirs = [path]
+    while len(dirs)>0:
+        root = dirs.pop()
+        if scandir is None:
+            entries = [ (os.path.join(root,name), os.lstat(os.path.join(root,name)))
+                        for name in os.listdir(root) ]
+        else:
+            entries = [ (de.path, de.stat(follow_symlinks=False)) for de in scandir(root) ]
+        for entry_path, st in entries:
+            if stat.S_ISDIR(st.st_mode):
+                ncalls += normalize_perms( entry_path, st, gid, std_dir_perms )
+                dirs.append( entry_path )
+            elif stat.S_ISREG(st.st_mode):
+                ncalls += normalize_perms( entry_path, st, gid, std_file_perms )
+            else:
+                continue  # e.g. a symbolic link; chown and chmod would change its target
+            nchecked += 1
+    # Then go up
+    dir = os.path.split(path)[0]
     try:
         while len(dir)>21:   # len("/p/css03/esgf_publish")
-            chgrp_perms( dir, group, std_dir_perms )
+            with perm_lock:
+                done = dir in parents_done
+                parents_done.add( dir )
+            if done:
+                nparents_skipped += 1
+            else:
+                ncalls += normalize_perms( dir, os.stat(dir), gid, std_dir_perms )
+                nchecked += 1
             dir = os.path.split(dir)[0]
     except:  # If we don't have write permission, we're finished.
         pass
+    with perm_lock:
+        perm_stats['checked'] += nchecked
+        perm_stats['calls'] += ncalls
+        # Unconditionally, every entry checked, and every parent skipped, would have cost a
+        # chown and a chmod.
+        perm_stats['saved'] += 2*(nchecked+nparents_skipped) - ncalls
 
-def run_by_date( ending ):
+# For run_by_date( incremental=True ): the high-water mark is the (latest_date, dataset_id) of the
+# last dataset selected.  Timestamps can tie, so the dataset_id is needed to tell which of the
+# datasets with the same latest_date have already been done.
+watermark_file = '/p/css03/scratch/publishing/CMIP6_watermark'
+latest_date_index = 'idx_dataset_latest_date'
+
+def read_watermark( sincewhen ):
+    """Returns the high-water mark (latest_date, dataset_id).  If there is none yet, this is the
+    first incremental run, and we start from the time in the file sincewhen, as a
+    non-incremental run would."""
+    if os.path.isfile( watermark_file ):
+        with open(watermark_file,'r') as f:
+            latest_date, dataset_id = f.readline().strip().split('|')
+        return latest_date, int(dataset_id)
+    with open(sincewhen,'r') as f:
+        beginning = f.readline().strip()
+    # A dataset_id larger than any real one means: only latest_date>beginning.
+    return beginning, sys.maxint
+
+def write_watermark( watermark ):
+    """Saves the high-water mark (latest_date, dataset_id), unless this is a dry run."""
+    if dryrun:
+        print "Normally would write",watermark,"to",watermark_file
+    else:
+        with open(watermark_file,'w') as f:
+            f.write( "%s|%s" % watermark )
+
+def has_latest_date_index():
+    """Returns True iff the dataset table has an index whose first column is latest_date, so that
+    a range query on latest_date doesn't have to scan the whole table."""
+    global conn
+    curs = conn.cursor()
+    try:
+        curs.execute( "PRAGMA index_list(dataset)" )
+        indexes = [ row[1] for row in curs.fetchall() ]
+        for index in indexes:
+            curs.execute( "PRAGMA index_info(%s)" % index )
+            columns = curs.fetchall()   # (seqno, cid, name)
+            if len(columns)>0 and columns[0][0]==0 and columns[0][2]=='latest_date':
+                return True
+        return False
+    finally:
+        curs.close()
+
+def check_latest_date_index( first_run, create=False ):
+    """Warns if there is no usable index on dataset.latest_date.  On the first incremental run,
+    offers to create one (and creates it without asking if create is True)."""
+    global conn
+    if has_latest_date_index():
+        return
+    cmd = "CREATE INDEX %s ON dataset (latest_date, dataset_id)" % latest_date_index
+    logging.warning( "no index on dataset.latest_date; each run will scan the dataset table" )
+    if not create:
+        if not first_run or not sys.stdin.isatty():
+            logging.warning( "   to fix this, run: %s" % cmd )
+            return
+        print "There is no index on dataset.latest_date.  Create one now, with"
+        print "  %s ?  (y/n)" % cmd
+        create = raw_input().lower() in ['y','yes']
+    if create and not dryrun:
+        curs = conn.cursor()
+        curs.execute( cmd )
+        conn.commit()
+        curs.close()
+        logging.info( "created index: %s" % cmd )
+
+def run_by_date( ending, incremental=False, create_index=False ):
     global conn, curs, dryrun, std_file_perms, std_dir_perms
     """This function extracts a list of publishable but unpublished datasets from the database,
     formats it, and sends it on to move_and_record() to move the data to esgf_publish and record
-    this action in file lists."""
+    this action in file lists.
+    If incremental is True, the datasets are those beyond a high-water mark (latest_date,
+    dataset_id) saved by the previous incremental run, rather than those after the time saved in
+    CMIP6_sincewhen; and the query is a range query which can use an index on latest_date.
+    If create_index is True, such an index will be created if there isn't one."""
     # If we also want to do CMIP-5 data, the filenames will have to depend on the host name - not done yet.
     if socket.gethostname()!='aimsdtn6':
         raise Exception("implemented only for CMIP-6 on aimsdtn6")
@@ -91,18 +231,32 @@ def run_by_date( ending ):
     db = '/var/lib/synda/sdt/sdt.db'
     setup( db )
     sincewhen = '/p/css03/scratch/publishing/CMIP6_sincewhen'
-    with open(sincewhen,'r') as f:
-        beginning = f.readline().strip()
+    if incremental:
+        first_run = not os.path.isfile( watermark_file )
+        watermark = read_watermark( sincewhen )
+        beginning = watermark[0]
+        check_latest_date_index( first_run, create_index )
+    else:
+        with open(sincewhen,'r') as f:
+            beginning = f.readline().strip()
     logging.info( "beginning=%s, ending=%s" % (beginning, ending) )
     if dryrun:
         print "beginning=%s, ending=%s" % (beginning, ending)
 
     # Get the new complete datasets from the database, and move them
     try:
-        cmd = "SELECT path_without_version,version FROM dataset WHERE status='complete' AND " +\
-              "latest_date>'%s' AND latest_date<='%s'" % (beginning, ending) 
         curs = conn.cursor()
-        curs.execute( cmd )
+        if incremental:
+            # The range condition on latest_date is what an index can serve; the rest of the
+            # WHERE clause only has to look at the rows with latest_date==beginning.
+            cmd = "SELECT path_without_version,version,latest_date,dataset_id FROM dataset "+\
+                  "WHERE latest_date>=? AND latest_date<=? AND status='complete' AND "+\
+                  "(latest_date>? OR dataset_id>?) ORDER BY latest_date,dataset_id"
+            curs.execute( cmd, (beginning, ending, beginning, watermark[1]) )
+        else:
+            cmd = "SELECT path_without_version,version FROM dataset WHERE status='complete' AND " +\
+                  "latest_date>'%s' AND latest_date<='%s'" % (beginning, ending) 
+            curs.execute( cmd )
         conn.commit()
         results = curs.fetchall()
         curs.close()
@@ -111,6 +265,7 @@ def run_by_date( ending ):
         logging.warning( "   query was %s" % cmd )
         finish()
         sys.exit()
+    logging.info( "%s datasets selected" % len(results) )
 
     three_paths = [
         # scratch+version, +version-headers, esgf_publish+version
@@ -129,6 +284,9 @@ def run_by_date( ending ):
     # Write out the new beginning for the next run.
     # If we didn't get here, the next time-based run will use the old beginning and recompute
     # whatever was missed this time.
+    if incremental and len(results)>0:
+        # results are ordered, so the last one is the new high-water mark
+        write_watermark( (results[-1][2], results[-1][3]) )
     if dryrun:
         print "Normally would write",ending,"to",sincewhen
     else:
@@ -162,6 +320,189 @@ def run_by_list( dataset_file ):
     move_and_record( three_paths, suffix )
 
 
+# The parallel move engine.  Datasets are moved by a pool of move_workers threads, but no more
+# than fs_limit of them may be moving into any one target file system at a time.
+fs_semaphores = {}                    # device number -> threading.BoundedSemaphore
+fs_semaphores_lock = threading.Lock()
+
+def target_device( path ):
+    """Returns the device number of the file system on which path is, or would be, created;
+    i.e. that of its nearest existing ancestor."""
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent==path:
+            break
+        path = parent
+    return os.stat(path).st_dev
+
+def fs_semaphore( path ):
+    """Returns the semaphore limiting the concurrent moves into path's file system."""
+    global fs_semaphores, fs_semaphores_lock, fs_limit
+    dev = target_device( path )
+    with fs_semaphores_lock:
+        if dev not in fs_semaphores:
+            fs_semaphores[dev] = threading.BoundedSemaphore( max( 1, fs_limit ) )
+        return fs_semaphores[dev]
+
+def renames( old, new ):
+    """Like os.renames(old,new), but safe when other threads are creating the same parent
+    directories of new."""
+    head = os.path.dirname(new)
+    if head and not os.path.exists(head):
+        try:
+            os.makedirs(head)
+        except OSError as e:
+            if e.errno!=errno.EEXIST:
+                raise e
+    os.rename( old, new )
+    head = os.path.dirname(old)
+    if head:
+        try:
+            os.removedirs(head)
+        except OSError:
+            pass
+
+# Cross-device moves.  os.rename() is cheap only within one file system.  Between file systems,
+# os.renames() would silently fall back to a slow serial copy, and a failure part way through
+# would leave the data split between scratch and esgf_publish.  Instead we copy the dataset into a
+# staging directory beside the target, with copy_threads threads, verify the sizes, and only then
+# rename the staging directory into place and delete the source.
+
+def cross_device( scrv, epbv ):
+    """Returns True iff moving scrv to epbv would cross from one file system to another."""
+    return os.path.exists(scrv) and os.stat(scrv).st_dev!=target_device(epbv)
+
+def tree_files( top ):
+    """Returns the subdirectories and files below top, as two lists of paths relative to top.
+    Each file is given as (relpath, size)."""
+    subdirs = []
+    files = []
+    for (root,dirs,fnames) in os.walk(top):
+        relroot = os.path.relpath( root, top )
+        for d in dirs:
+            subdirs.append( os.path.normpath(os.path.join(relroot,d)) )
+        for fname in fnames:
+            relpath = os.path.normpath( os.path.join(relroot,fname) )
+            files.append( (relpath, os.path.getsize(os.path.join(root,fname))) )
+    return subdirs, files
+
+def copy_file( src_dst ):
+    """Copies the file src to dst, in chunks of copy_chunk bytes, preserving its times.
+    The argument is the tuple (src, dst).  Returns the number of bytes copied."""
+    global copy_chunk
+    src, dst = src_dst
+    nbytes = 0
+    with open(src,'rb') as fin:
+        with open(dst,'wb') as fout:
+            while True:
+                buf = fin.read(copy_chunk)
+                if not buf:
+                    break
+                fout.write(buf)
+                nbytes += len(buf)
+    shutil.copystat( src, dst )
+    return nbytes
+
+def copy_verify_move( scrv, epbv ):
+    """Moves the dataset directory scrv to epbv on another file system, by a multi-threaded copy
+    to a staging directory, size verification, and an atomic rename of the staging directory to
+    epbv.  If anything fails, the staging directory is removed and scrv is left as it was.
+    If only the deletion of scrv afterwards fails, what is left of it is logged, and the move
+    still counts as done.  Returns the number of bytes copied."""
+    global copy_threads
+    if os.path.isdir(epbv) and len(os.listdir(epbv))==0:
+        os.rmdir(epbv)   # os.rename() would replace an empty directory, too
+    if os.path.exists(epbv):
+        raise OSError( errno.EEXIST, "target already exists", epbv )
+    staging = epbv+'.partial'
+    if os.path.exists(staging):
+        shutil.rmtree(staging)   # left over from an earlier failure
+    t0 = time.time()
+    subdirs, files = tree_files( scrv )
+    try:
+        os.makedirs( staging )
+        for d in subdirs:
+            os.makedirs( os.path.join(staging,d) )
+        pool = ThreadPool( max( 1, min( copy_threads, len(files) ) ) )
+        try:
+            nbytes = sum( pool.map( copy_file, [ (os.path.join(scrv,f), os.path.join(staging,f))
+                                                 for f,size in files ] ) )
+        finally:
+            pool.close()
+            pool.join()
+        for f, size in files:
+            if os.path.getsize( os.path.join(staging,f) )!=size:
+                raise IOError( "size of copy of %s doesn't match" % os.path.join(scrv,f) )
+        os.rename( staging, epbv )
+    except Exception as e:
+        logging.warning( "copy of %s to %s failed, removing %s" % (scrv,epbv,staging) )
+        shutil.rmtree( staging, ignore_errors=True )
+        raise e
+    # The copy is complete and in place.  Now delete the source, as os.renames() would.
+    # The dataset has been moved even if that fails, so failures are only logged.
+    leftovers = []
+    shutil.rmtree( scrv, onerror=(lambda func, path, exc_info: leftovers.append(path)) )
+    if len(leftovers)>0:
+        logging.warning( "copied %s to %s, but could not delete from the source %s" %
+                         ( scrv, epbv, ' '.join(leftovers) ) )
+    try:
+        os.removedirs( os.path.dirname(scrv) )
+    except OSError:
+        pass
+    elapsed = time.time()-t0
+    logging.info( "copied %s bytes from %s to %s in %.1f seconds, %.1f MiB/s" %
+                  ( nbytes, scrv, epbv, elapsed, nbytes/1024./1024/elapsed if elapsed>0 else 0 ) )
+    return nbytes
+
+def move_one( scrv, vnh, epbv ):
+    """Moves one dataset from scrv to epbv and fixes its group and permissions.  The arguments
+    are as described in move_and_record().  Returns (outcome, vnh, epbv, seconds) where outcome
+    is one of 'moved', 'split', 'nosrc', 'failed' and seconds is the time taken.  This doesn't
+    raise an exception; any problem becomes the outcome 'failed'."""
+    t0 = time.time()
+    try:
+        if cross_device( scrv, epbv ):
+            copy_verify_move( scrv, epbv )
+        else:
+            renames(scrv,epbv)
+        chgrp_perms_updown( epbv, group='climatew' )
+        outcome = 'moved'
+        logging.info( "moved %s to %s in %.1f seconds" % (scrv,epbv,time.time()-t0) )
+    except Exception as e:
+        logging.warning( "could not move %s to %s due to %s" % (scrv,epbv,e) )
+        # Classifying the failure needs the directories to be readable, which they may not be.
+        # Whatever happens, this must return an outcome, so that the other moves are recorded.
+        try:
+            if os.path.isdir(epbv) and len(os.listdir(epbv))>0 and (
+                    not os.path.isdir(scrv) or len(os.listdir(scrv))==0):
+                # data have already been moved; nothing left here
+                outcome = 'moved'
+                logging.info("data is already in %s" % epbv)
+            elif os.path.isdir(epbv) and len(os.listdir(epbv))>0 and\
+                 os.path.isdir(scrv) and len(os.listdir(scrv))>0:
+                # data in both directories.  Probably the dataset was changed
+                outcome = 'split'
+                logging.info("data is in both %s and %s" % (scrv,epbv) )
+            elif not os.path.isdir(scrv):
+                # The source doesn't exist, and it hasn't already been (substantively) moved.
+                outcome = 'nosrc'
+                logging.info("source %s does not exist" % scrv )
+            else:
+                # don't know what's wrong, could be a permissions problem for making epbv
+                outcome = 'failed'
+                logging.info("unknown problem with moving data %s" %vnh )
+        except Exception as e:
+            outcome = 'failed'
+            logging.info( "could not examine %s or %s due to %s" % (scrv,epbv,e) )
+    return outcome, vnh, epbv, time.time()-t0
+
+def move_one_limited( three_path ):
+    """Calls move_one() on a (scrv, vnh, epbv) tuple, after waiting until fewer than fs_limit
+    moves are in progress into the target file system."""
+    scrv, vnh, epbv = three_path
+    with fs_semaphore( epbv ):
+        return move_one( scrv, vnh, epbv )
+
 def move_and_record( three_paths, suffix ):
     """Move datasets from /scratch/ to /esgf_publish/.  Record successes in a file
     datasets_since_<suffix> and failures in a file unmoved_datasets_<suffix>.
@@ -172,41 +513,46 @@ def move_and_record( three_paths, suffix ):
       vnh  is scrv without header directories,                   CMIP6/activity/.../var/grid/version
       epbv is scrv moved to /esgf_publish  /p/css03/esgf_publish/CMIP6/activity/.../var/grid/version
     """
-    global conn, curs, dryrun, std_file_perms, std_dir_perms
+    global conn, curs, dryrun, std_file_perms, std_dir_perms, move_workers
     moved_datasets = []
     split_datasets = []
     nosrc_datasets = []
     failed_datasets = []
     if dryrun:
+        copy_bytes = 0
         for scrv,vnh,epbv in three_paths:
-            print "would move",scrv,"to",epbv
+            if cross_device( scrv, epbv ):
+                nbytes = sum( [ size for f,size in tree_files(scrv)[1] ] )
+                copy_bytes += nbytes
+                print "would copy",scrv,"to",epbv,"across file systems,",nbytes,"bytes"
+            else:
+                print "would move",scrv,"to",epbv
+        print "total bytes to be copied across file systems:",copy_bytes
     else:
-        for scrv,vnh,epbv in three_paths:
-            try:
-                os.renames(scrv,epbv)
-                chgrp_perms_updown( epbv, group='climatew' )
-                logging.info( "moved %s to %s" % (scrv,epbv) )
+        t0 = time.time()
+        pool = ThreadPool( max( 1, move_workers ) )
+        try:
+            # map() returns the results in the order of three_paths, so the lists are ordered
+            # just as they would be for serial moves.
+            results = pool.map( move_one_limited, three_paths )
+        finally:
+            pool.close()
+            pool.join()
+        elapsed = time.time()-t0
+        for outcome, vnh, epbv, seconds in results:
+            if outcome=='moved':
                 moved_datasets.append( (vnh,epbv) )
-            except Exception as e:
-                logging.warning( "could not move %s to %s due to %s" % (scrv,epbv,e) )
-                if (os.path.isdir(epbv) and len(os.listdir(epbv))>0 and (
-                        not os.path.isdir(scrv)) or len(os.listdir(scrv))==0):
-                    # data have already been moved; nothing left here
-                    moved_datasets.append( (vnh,epbv) )
-                    logging.info("data is already in %s" % epbv)
-                elif os.path.isdir(epbv) and len(os.listdir(epbv))>0 and\
-                     os.path.isdir(scrv) and len(os.listdir(scrv))>0:
-                    # data in both directories.  Probably the dataset was changed
-                    split_datasets.append( vnh )
-                    logging.info("data is in both %s and %s" % (scrv,epbv) )
-                elif not os.path.isdir(scrv):
-                    # The source doesn't exist, and it hasn't already been (substantively) moved.
-                    nosrc_datasets.append( vnh )
-                    logging.info("source %s does not exist" % scrv )
-                else:
-                    # don't know what's wrong, could be a permissions problem for making epbv
-                    failed_datasets.append( vnh )
-                    logging.info("unknown problem with moving data %s" %vnh )
+            elif outcome=='split':
+                split_datasets.append( vnh )
+            elif outcome=='nosrc':
+                nosrc_datasets.append( vnh )
+            else:
+                failed_datasets.append( vnh )
+        logging.info( "moved %s of %s datasets in %.1f seconds with %s workers, %.2f datasets/sec" %
+                      ( len(moved_datasets), len(three_paths), elapsed, move_workers,
+                        len(three_paths)/elapsed if elapsed>0 else 0 ) )
+        logging.info( "permissions: checked %s entries, made %s chown/chmod calls, saved %s" %
+                      ( perm_stats['checked'], perm_stats['calls'], perm_stats['saved'] ) )
 
     # Write a file listing the new locations of the new complete datasets.
     #   To prevent premature processing of the file, it will be written to /tmp, permissions limited,
@@ -255,10 +601,27 @@ if __name__ == '__main__':
                     "If --datasets is not supplied, datasets were chosen by date.",
                     required=False, default=None )
     p.add_argument( "--dryrun", action="store_true" )
+    p.add_argument( "--incremental", action="store_true",
+                    help="select datasets beyond the high-water mark (latest_date, dataset_id) of "+
+                    "the last incremental run, with a query which can use an index" )
+    p.add_argument( "--create_index", action="store_true",
+                    help="with --incremental, create an index on dataset.latest_date if there "+
+                    "isn't one" )
+    p.add_argument( "--workers", dest="workers", type=int, required=False, default=8,
+                    help="number of datasets to move at once" )
+    p.add_argument( "--fs_limit", dest="fs_limit", type=int, required=False, default=4,
+                    help="maximum number of datasets to move at once into any one file system" )
+    p.add_argument( "--copy_threads", dest="copy_threads", type=int, required=False, default=4,
+                    help="number of threads copying one dataset, if it has to be copied between "+
+                    "file systems" )
     args = p.parse_args( sys.argv[1:] )
     if args.dryrun==True:
         dryrun = True
+    move_workers = args.workers
+    fs_limit = args.fs_limit
+    copy_threads = args.copy_threads
     if args.dataset_file is  None:
-        run_by_date( ending=args.ending )
+        run_by_date( ending=args.ending, incremental=args.incremental,
+                     create_index=args.create_index )
     else:
         run_by_list( dataset_file=args.dataset_file )
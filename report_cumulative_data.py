@@ -1,31 +1,28 @@
 #!/usr/bin/env python
 
 """Reports the cumulative data acquired by Synda, in a .csv file, for later plotting."""
-"""Here is how to get ready to run this.  It involves making a temporary database with a "size"
-column for datasets.  Normally only files have a "size".
-For performance reasons, I indexed last_done_transfer_date.
-  mkdir $HOME/db
-  cp /p/css03/painter/db/sdt.db_6_2021-05-10 $HOME/db/sdt-tmp.db 
-  sqlite3 ~/db/sdt-tmp.db
-  # (Don't run the next line unless you are very sure that you're doing it to sdt-tmp.db ! )
-  sqlite> DELETE FROM dataset WHERE status NOT LIKE 'complete%' AND status NOT LIKE 'published%';
-  sqlite> ALTER TABLE dataset ADD size INT;
-  sqlite> UPDATE dataset SET size=(SELECT SUM(size) FROM file WHERE file.dataset_id=dataset.dataset_id)
-  sqlite> .quit
-
-I also did this for an earlier version of this script, but it should no longer be useful:
+"""The size of each dataset comes from a summary table, dataset_size, kept in a side database
+(summary_db) which is attached to the Synda database.  It holds, for each dataset_id, the total
+size and number of its files, and the date at which the last of them was done.
+The first run builds it with a single GROUP BY over the file table; later runs summarize again
+only the datasets with files which have been done since then.  Use --rebuild to build it again from scratch.
+This replaces the old preparation, which needed a temporary copy of the database with a "size"
+column added to the dataset table.
+
+For performance reasons, you may want to index last_done_transfer_date:
   sqlite> CREATE INDEX idx_dataset_6 on dataset (last_done_transfer_date);
 """
 
-
 import sys, os, pdb
-import logging
+import logging, argparse
 import sqlite3
 import datetime
+import numpy
 import debug
-global db, conn, curs
+global db, summary_db, conn, curs
 
-db = os.path.expanduser('~/db/sdt-tmp.db')
+db = '/var/lib/synda/sdt/sdt.db'
+summary_db = os.path.expanduser('~/db/dataset_size.db')
 rcdf = os.path.expanduser('~/db/rcd-')
 conn = None
 activities = [
@@ -34,8 +31,9 @@ activities = [
  'ScenarioMIP', 'VolMIP' ]
 
 def setup():
-    """Initializes logging and the connection to the database, etc."""
-    global db, conn, curs
+    """Initializes logging and the connection to the database, etc.
+    The summary database is attached as 'summary'."""
+    global db, summary_db, conn, curs
 
     logfile = '/p/css03/scratch/logs/report_cumulative_data.log'
     logging.basicConfig( filename=logfile, level=logging.INFO, format='%(asctime)s %(message)s' )
@@ -45,45 +43,242 @@ def setup():
         timeout = 12000  # in seconds; i.e. 200 minutes
         conn = sqlite3.connect( db, timeout )
     curs = conn.cursor()
+    curs.execute( "ATTACH DATABASE ? AS summary", (summary_db,) )
+    curs.execute( "CREATE TABLE IF NOT EXISTS summary.dataset_size ( dataset_id INTEGER PRIMARY KEY,"+
+                  " size INTEGER, nfiles INTEGER, completion_date TEXT, data_node TEXT )" )
+    curs.execute( "PRAGMA summary.table_info(dataset_size)" )
+    if 'data_node' not in [ row[1] for row in curs.fetchall() ]:
+        # The table was made by an older version of this script.  Emptying it forces a rebuild.
+        curs.execute( "ALTER TABLE summary.dataset_size ADD data_node TEXT" )
+        curs.execute( "DELETE FROM summary.dataset_size" )
+    conn.commit()
 
 def finish():
     """Closes connections to databases, etc."""
     global db, conn, curs
     conn.commit()
+    curs.close()
     conn.close()
     conn = None
-    curs.close()
 
-setup()
+def summarize_datasets( affected=False ):
+    """Fills in summary.dataset_size from the file table, for all datasets; or if affected is
+    True, only for the datasets listed in the temporary table 'affected'.  Every file of a
+    dataset is counted, whatever its status, as the old preparation did.
+    A dataset may have been downloaded from more than one data_node.  Its data_node is the one
+    from which the most bytes of it came; a tie goes to the data_node which sorts first.
+    Returns the number of datasets."""
+    global curs
+    cmd = "SELECT dataset_id, data_node, SUM(size), COUNT(*), MAX(end_date) FROM file"
+    if affected:
+        cmd += " WHERE dataset_id IN (SELECT dataset_id FROM temp.affected)"
+    curs.execute( cmd+" GROUP BY dataset_id, data_node" )
+    datasets = {}   # dataset_id: [size, nfiles, completion_date, data_node, size from data_node]
+    for dataset_id, data_node, size, nfiles, end_date in curs.fetchall():
+        size = size or 0
+        if dataset_id not in datasets:
+            datasets[dataset_id] = [ size, nfiles, end_date, data_node, size ]
+            continue
+        ds = datasets[dataset_id]
+        ds[0] += size
+        ds[1] += nfiles
+        ds[2] = max( ds[2], end_date )
+        if size>ds[4] or ( size==ds[4] and data_node<ds[3] ):
+            ds[3:5] = [ data_node, size ]
+    curs.executemany( "INSERT INTO summary.dataset_size"+
+                      " (dataset_id,size,nfiles,completion_date,data_node) VALUES (?,?,?,?,?)",
+                      [ [dataset_id]+ds[:4] for dataset_id, ds in datasets.iteritems() ] )
+    return len(datasets)
+
+def update_dataset_size( rebuild=False ):
+    """Brings the summary table dataset_size up to date.  Each dataset which has a file done
+    since the latest completion_date in the table is summarized again from all its files; so a
+    file which has been downloaded again isn't counted twice.  If rebuild is True, or the table
+    is empty, it will be built from the whole file table."""
+    global conn, curs
+    try:
+        if not rebuild:
+            curs.execute( "SELECT MAX(completion_date) FROM summary.dataset_size" )
+            since = curs.fetchone()[0]
+        if rebuild or since is None:
+            curs.execute( "DELETE FROM summary.dataset_size" )
+            n = summarize_datasets()
+            logging.info( "built dataset_size for %s datasets" % n )
+        else:
+            curs.execute( "DROP TABLE IF EXISTS temp.affected" )
+            curs.execute( "CREATE TEMP TABLE affected AS"+
+                          " SELECT DISTINCT dataset_id FROM file WHERE end_date>?", (since,) )
+            curs.execute( "DELETE FROM summary.dataset_size WHERE dataset_id IN"+
+                          " (SELECT dataset_id FROM temp.affected)" )
+            n = summarize_datasets( affected=True )
+            curs.execute( "DROP TABLE temp.affected" )
+            logging.info( "updated dataset_size for %s datasets with files done since %s" %
+                          ( n, since ) )
+    except Exception as e:
+        logging.debug( "exception in update_dataset_size: %s" % e )
+        conn.rollback()
+        raise e
+    conn.commit()
 
-for activity in activities:
-    rcd = open( rcdf+activity+'.csv', 'w' )
-    rcd.write( "date,data_footprint\n" )
-    end_date = datetime.date(2018, 7, 1)
-    stop_date = datetime.date(2021, 5, 10)
-    delta = datetime.timedelta(days=1)
+# Each dataset is described by the fields of its dataset_functional_id, e.g.
+# 'CMIP6.CMIP.IPSL.IPSL-CM6A-LR.piControl.r1i1p1f1.AERmon.od550lt1aer.gr.v20180314'
+# and by its data_node.  A grouping function returns the key of a dataset, given both.
+frequencies = [ 'subhr', '1hr', '3hr', '6hr', 'day', 'mon', 'yr', 'dec', 'fx' ]
 
-    if activity=='all':
-        cmd = "SELECT last_done_transfer_date,size,dataset_functional_id FROM dataset"
+def frequency_of( table_id ):
+    """Returns the frequency of a CMIP6 table, e.g. 'mon' for 'AERmon', 'day' for 'CFday',
+    '1hr' for 'E1hrClimMon'.  Returns the table_id if no frequency is recognized."""
+    for freq in frequencies:
+        if table_id.find(freq)>=0:
+            return freq
+    return table_id
+
+def field_of( fields, i ):
+    if len(fields)>i:
+        return fields[i]
     else:
-        cmd = "SELECT last_done_transfer_date,size,dataset_functional_id FROM dataset"+\
-              " WHERE dataset_functional_id LIKE '%s%s%s'" % ( "%.",activity,".%" )
+        return 'unknown'
+
+groupings = {
+    'activity':    ( lambda fields, data_node: field_of( fields, 1 ) ),
+    'institution': ( lambda fields, data_node: field_of( fields, 2 ) ),
+    'source_id':   ( lambda fields, data_node: field_of( fields, 3 ) ),
+    'frequency':   ( lambda fields, data_node: frequency_of( field_of( fields, 6 ) ) ),
+    'data_node':   ( lambda fields, data_node: data_node or 'unknown' )
+    }
+
+def load_datasets():
+    """Reads the completion date, size, functional_id fields and data_node of every complete or
+    published dataset, in one query.  Returns numpy arrays of dates (datetime64[D]) and sizes,
+    and lists of the split functional_ids and of the data_nodes."""
+    global curs
+    cmd = "SELECT d.last_done_transfer_date,s.size,d.dataset_functional_id,s.data_node"+\
+          " FROM dataset d JOIN summary.dataset_size s ON d.dataset_id=s.dataset_id WHERE"+\
+          " (d.status LIKE 'complete%' OR d.status LIKE 'published%') AND"+\
+          " d.last_done_transfer_date IS NOT NULL AND s.size IS NOT NULL"
     curs.execute( cmd )
-    results = curs.fetchall()  # date, size, dataset_functional_id
-    # ...it's all strings, e.g. results[0]=
+    results = curs.fetchall()
+    # The rows look like
     # (u'2018-03-20 09:46:30.346505', 9940604,
-    #  u'CMIP6.CMIP.IPSL.IPSL-CM6A-LR.piControl.r1i1p1f1.AERmon.od550lt1aer.gr.v20180314')
-    results.sort( key=(lambda x: x[0] ) )
-    lastsize = 0
-    lastdate = "2000-01-01"
-    for result in results:
-        thissize = result[1] + lastsize
-        thisdate = result[0][:10]
-        if thisdate>lastdate:
-            rcd.write( lastdate+" 00:00:00,"+str(lastsize)+".0\n" )
-        lastsize = thissize
-        lastdate = thisdate
-    rcd.write( lastdate+" 00:00:00,"+str(lastsize)+".0\n" )
-    rcd.close()
-
-finish()
+    #  u'CMIP6.CMIP.IPSL.IPSL-CM6A-LR.piControl.r1i1p1f1.AERmon.od550lt1aer.gr.v20180314',
+    #  u'vesg.ipsl.upmc.fr')
+    dates = numpy.array( [ r[0][:10] for r in results ], dtype='datetime64[D]' )
+    sizes = numpy.array( [ r[1] for r in results ], dtype=numpy.int64 )
+    fields = [ r[2].split('.') for r in results ]
+    data_nodes = [ r[3] for r in results ]
+    return dates, sizes, fields, data_nodes
+
+def cumulative_series( dates, sizes, keys, start, stop ):
+    """Computes daily cumulative sums of sizes, for each distinct key, from start to stop.
+    dates, sizes, keys are arrays of equal length; start and stop are datetime64[D].
+    The value for a day includes everything done on or before that day; so what was done before
+    start is in the first day's value, and what was done after stop isn't anywhere.
+    Returns days, an array of the days; groups, an array of the distinct keys;
+    and a 2-D int64 array whose row i is the cumulative series for groups[i]."""
+    days = numpy.arange( start, stop+numpy.timedelta64(1,'D'), dtype='datetime64[D]' )
+    groups, igroups = numpy.unique( keys, return_inverse=True )
+    series = numpy.zeros( ( len(groups), len(days) ), dtype=numpy.int64 )
+    keep = dates<=stop
+    idays = numpy.clip( ( dates[keep]-start ).astype(numpy.int64), 0, len(days)-1 )
+    # Sum the sizes for each (group,day) exactly, in int64.
+    cells = igroups[keep]*len(days) + idays
+    order = numpy.argsort( cells, kind='mergesort' )
+    cells = cells[order]
+    if len(cells)>0:
+        ucells, ifirst = numpy.unique( cells, return_index=True )
+        series.flat[ucells] = numpy.add.reduceat( sizes[keep][order], ifirst )
+    numpy.cumsum( series, axis=1, out=series )
+    return days, groups, series
+
+def last_date_in( filename ):
+    """Returns the date, 'YYYY-MM-DD', of the last line of a .csv file written by write_series(),
+    or None if there is no such file or it has no data lines."""
+    if not os.path.isfile( filename ):
+        return None
+    with open( filename, 'rb' ) as f:
+        f.seek( 0, os.SEEK_END )
+        f.seek( max( 0, f.tell()-4096 ) )
+        lines = f.read().splitlines()
+    if len(lines)==0 or not lines[-1][0:4].isdigit():
+        return None
+    return lines[-1][:10]
+
+def write_series( filename, days, values, rewrite=False ):
+    """Writes one cumulative series to a .csv file.  If the file already exists, only the days
+    after its last line are appended to it, unless rewrite is True."""
+    daystrs = days.astype(str)
+    last = None if rewrite else last_date_in( filename )
+    if last is None:
+        rcd = open( filename, 'w' )
+        rcd.write( "date,data_footprint\n" )
+    else:
+        rcd = open( filename, 'a' )
+    with rcd:
+        rcd.write( ''.join( [ "%s 00:00:00,%d.0\n" % dv for dv in zip( daystrs, values )
+                              if last is None or dv[0]>last ] ) )
+
+def write_cumulative_data( group_bys=['activity'], start=None, stop=None, rewrite=False ):
+    """Writes .csv files of daily cumulative data from start to stop, which are 'YYYY-MM-DD'
+    strings and default to the first date in the database and yesterday, the last full day.
+    An existing file is extended by the days after its last line, see write_series(); unless
+    rewrite is True, in which case it is written again from start.
+    There is one file rcd-all.csv for all data.  Then for each grouping in group_bys (see
+    groupings) there is a file for each key, e.g. rcd-institution-IPSL.csv; except that the
+    activity files are named rcd-<activity>.csv, and every activity in the list activities gets
+    one.  All the series come from a single load of the database."""
+    dates, sizes, fields, data_nodes = load_datasets()
+    if start is None:
+        start = dates.min() if len(dates)>0 else numpy.datetime64( 'today', 'D' )
+    if stop is None:
+        stop = numpy.datetime64( 'today', 'D' ) - numpy.timedelta64( 1, 'D' )
+    start = numpy.datetime64( start, 'D' )
+    stop = numpy.datetime64( stop, 'D' )
+
+    days, groups, series = cumulative_series( dates, sizes, numpy.zeros( len(dates), dtype=int ),
+                                              start, stop )
+    write_series( rcdf+'all.csv', days, series[0] if len(groups)>0 else numpy.zeros(len(days)),
+                  rewrite )
+    for group_by in group_bys:
+        keyof = groupings[group_by]
+        keys = numpy.array( [ keyof( f, dn ) for f, dn in zip( fields, data_nodes ) ] )
+        days, groups, series = cumulative_series( dates, sizes, keys, start, stop )
+        if group_by=='activity':
+            for activity in activities:
+                if activity!='all' and activity not in groups:
+                    write_series( rcdf+activity+'.csv', days, numpy.zeros( len(days), dtype=int ),
+                                  rewrite )
+            for i in range(len(groups)):
+                if groups[i] not in activities:
+                    logging.info( "found activity %s, which isn't in the standard list" % groups[i] )
+                write_series( rcdf+groups[i]+'.csv', days, series[i], rewrite )
+        else:
+            for i in range(len(groups)):
+                write_series( rcdf+group_by+'-'+groups[i]+'.csv', days, series[i], rewrite )
+        logging.info( "wrote %s series by %s" % ( len(groups), group_by ) )
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(
+        description="Write .csv files of the cumulative data acquired by Synda." )
+    p.add_argument( "--db", dest="db", required=False, default=db, help=
+                    "the Synda database" )
+    p.add_argument( "--summary_db", dest="summary_db", required=False, default=summary_db, help=
+                    "side database for the dataset_size summary table" )
+    p.add_argument( "--rebuild", dest="rebuild", action="store_true", default=False, help=
+                    "build the dataset_size summary again from the whole file table" )
+    p.add_argument( "--group_by", dest="group_by", required=False, nargs='+',
+                    default=['activity'], choices=sorted(groupings.keys()), help=
+                    "groupings for which to write cumulative series, e.g. activity institution" )
+    p.add_argument( "--start", dest="start", required=False, default=None, help=
+                    "first date of the series, YYYY-MM-DD; default is the first date in the data" )
+    p.add_argument( "--stop", dest="stop", required=False, default=None, help=
+                    "last date of the series, YYYY-MM-DD; default is yesterday" )
+    p.add_argument( "--rewrite", dest="rewrite", action="store_true", default=False, help=
+                    "write the .csv files again from the start, rather than appending new days" )
+    args = p.parse_args( sys.argv[1:] )
+    db = args.db
+    summary_db = args.summary_db
+
+    setup()
+    update_dataset_size( args.rebuild )
+    write_cumulative_data( args.group_by, args.start, args.stop, args.rewrite )
+    finish()
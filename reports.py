@@ -4,7 +4,8 @@
 
 from datetime import datetime, timedelta
 from pprint import pprint
-import sys, os, pdb
+import sys, os, pdb, mmap, re, gzip, io, time
+import argparse, sqlite3, multiprocessing
 import debug
 
 global inst, scheme, TransferLOG, start_timeN
@@ -13,37 +14,152 @@ scheme = {}
 start_timeN = 7 # an integer number of days before present, normally 7
 TransferLOG  = '/var/log/synda/sdt/transfer.log'  # LLNL standard
 DiscoveryLOG = '/var/log/synda/sdt/discovery.log' # LLNL standard
+RetractedLOG = '/p/css03/scratch/logs/retracted.log'
+MetricsDB = '/p/css03/scratch/publishing/transfer_metrics.db'  # see update_metrics()
+chunk_min = 4*1024*1024   # minimum size in bytes of a chunk of log file, see scan_tasks()
+max_templates = 20        # the number of unknown-error templates to report
+metrics_keep_days = 366   # days of counts and lines kept in the transfer metrics store
 #TransferLOG  = '/etc/synda/sdt/log/transfer.log'  # master branch default
 #DiscoveryLOG = '/etc/synda/sdt/log/discovery.log' # master branch default
 
-def tail(f, n):
-    """runs the operating system's 'tail', probably faster than
-    doing it in Python"""
-    stdin,stdout = os.popen2("tail -n "+str(n)+" "+f)
-    stdin.close()
-    lines = stdout.readlines(); stdout.close()
-    return lines
+def timestamped( line ):
+    """Returns True if the line begins with a time, as Synda and our own scripts log it, e.g.
+    "2020-10-22 11:32:12".  Other lines, e.g. of a traceback, continue the previous log entry."""
+    return line[4:5]=='-' and line[7:8]=='-' and line[0:4].isdigit()
 
-def logsince( logfile, starttime, taillen=15123456 ):
-    """returns lines of a log file since a start time.
+def log_seek( logfile, starttime ):
+    """Returns the byte offset of the first line of a log file whose time is at or after starttime.
+    If there is no such line, returns the size of the file.
+    This is a binary search over a memory map of the file, reading only the time at the start of
+    a few dozen lines; so it takes almost no time or memory, however big the file.
+    The log file is assumed to be in time order.  Lines which don't begin with a time are
+    skipped over, i.e. they are treated as if they had the time of the next timestamped line."""
+    starttime = starttime.replace('T',' ')[:19]
+    size = os.path.getsize( logfile )
+    if size==0:
+        return 0
+    with open( logfile, 'rb' ) as f:
+        mm = mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ )
+        try:
+            def first_timestamped( offset ):
+                # Returns the start of the first timestamped line at or after offset, or size.
+                if offset>0:
+                    offset = mm.find( '\n', offset-1 )+1
+                    if offset==0:
+                        return size
+                while offset<size and not timestamped( mm[offset:offset+19] ):
+                    offset = mm.find( '\n', offset )+1
+                    if offset==0:
+                        return size
+                return offset
+            lo = 0
+            hi = size
+            while lo<hi:
+                mid = (lo+hi)//2
+                line = first_timestamped( mid )
+                if line>=size or mm[line:line+19]>=starttime:
+                    hi = mid
+                else:
+                    lo = mid+1
+            return first_timestamped( lo )
+        finally:
+            mm.close()
+
+def log_segments( logfile ):
+    """Returns the paths of the segments of a log file, oldest first.  These are the rotated
+    segments logfile.N ... logfile.2, logfile.1, any of which may be compressed as
+    logfile.N.gz; and then logfile itself."""
+    segments = []
+    n = 1
+    while True:
+        for path in ( '%s.%d' % (logfile,n), '%s.%d.gz' % (logfile,n) ):
+            if os.path.isfile( path ):
+                segments.append( path )
+                break
+        else:
+            break
+        n += 1
+    segments.reverse()
+    if os.path.isfile( logfile ):
+        segments.append( logfile )
+    return segments
+
+def open_segment( path ):
+    """Opens a segment of a log file for reading.  A .gz segment is decompressed as it is read."""
+    if path.endswith('.gz'):
+        return io.BufferedReader( gzip.open( path, 'rb' ) )
+    else:
+        return open( path, 'r' )
+
+def log_head( path ):
+    """Returns the first line of a log segment, or '' if it doesn't yet have a complete line.
+    This identifies a log file after it has been rotated, even if it has been compressed."""
+    with open_segment( path ) as f:
+        line = f.readline()
+    return line if line.endswith('\n') else ''
+
+def segment_start( path ):
+    """Returns the time of the first timestamped line of a log segment, or None."""
+    with open_segment( path ) as f:
+        for line in f:
+            if timestamped( line ):
+                return line[:19]
+    return None
+
+def segments_since( logfile, starttime ):
+    """Returns the paths of the segments of a log file (see log_segments()) which may have
+    lines since starttime, oldest first."""
+    segments = log_segments( logfile )
+    if len(segments)==0:
+        sys.stderr.write( "no log file %s\n" % logfile )
+        return []
+    # Start with the newest segment which begins before starttime.  Older segments end before it.
+    first = 0
+    for i in range( len(segments)-1, 0, -1 ):
+        start = segment_start( segments[i] )
+        if start is not None and start<starttime.replace('T',' ')[:19]:
+            first = i
+            break
+    return segments[first:]
+
+def loglines_since( logfile, starttime ):
+    """Generates the lines of a log file since a start time, in the format described in
+    logsince().  Only the timestamped lines are generated.
+    The lines come from the rotated segments of the log file as well as the current one, see
+    log_segments(); but segments which end before starttime aren't read.  They are read lazily,
+    so a long time since starttime needs no more memory than a short one."""
+    starttime = starttime.replace('T',' ')
+    for path in segments_since( logfile, starttime ):
+        for line in segment_lines_since( path, starttime ):
+            yield line
 
-    The option taillen is the how many lines of the end of the file are sufficient to ensure
-    coverage of all logging since starttime.
-    The last 15 million lines of the log file will reliably cover transfer.log and other log files
-    for several days, in all Synda use that I have seen.  It will sometimes, maybe usually, work for
-    a week of transfer.log, the biggest one.  A tenth of that is not sufficient to guarantee a even
-    one-day coverage of transfer.log.  A third of that often covers a full day.  These are enough
-    lines so that getting them may take a significant amount of time.
+def segment_lines_since( path, starttime ):
+    """Generates the timestamped lines of one log segment since a start time, "2020-10-22 11:32:12".
+    A plain segment is entered with log_seek(); a compressed one is read from its beginning."""
+    with open_segment( path ) as f:
+        if not path.endswith('.gz'):
+            f.seek( log_seek( path, starttime ) )
+        for line in f:
+            if timestamped( line ) and line[:19]>=starttime[:19]:
+                yield line
+
+def counted( lines, counter ):
+    """Generates the supplied lines, counting them in counter['nlines']."""
+    for line in lines:
+        counter['nlines'] += 1
+        yield line
+
+def logsince( logfile, starttime ):
+    """returns lines of a log file since a start time.
 
     It is expected that each line will begin with a time.  The format of this time and of
     starttime format is Synda's, i.e.  "2020-10-22 11:32:12".
+    The first such line is found by log_seek(), so the whole time since starttime is covered
+    however big the log file is, and even if the log file has been rotated since then.
+    Lines without a time are omitted.
+    This returns a list of all the lines.  To read them one at a time, use loglines_since().
     """
-    starttime = starttime.replace('T',' ')
-    lastlines = tail( logfile, taillen )
-    datedlines = [ l for l in lastlines if l[0:4]==starttime[0:4] or
-                   l[0:4]==str(int(starttime[0:4])+1) ]
-    sincelines = [ l for l in datedlines if l[:19]>=starttime[:19] ]
-    return sincelines
+    return list( loglines_since( logfile, starttime ) )
 
 def logline_datanode( ll ):
     """Finds the first url (if any) in a line of transfer.log and returns the part before the
@@ -80,129 +196,418 @@ def logline_datanode( ll ):
 
     return datanode
 
-def transfer_error_counts( sincelines ):
-    """returns file transfer error counts in sincelines, a subset of transfer.log
-    """
-    known_errors = [
-        "ERROR 503: Service Unavailable", "503 Service Temporarily Unavailable",
-        "Server side credential failure", "Cannot find trusted CA certificate",
-        "Valid credentials could not be found",
-        "/var/tmp/synda/sdt/1682/.esg/credentials.pem is not a valid file",
-        "Temporary failure in name resolution", "unable to resolve host address",
-        "Connection timed out", "Connection refused", "Connection reset by peer",
-        "Bad Gateway" , "504 Gateway Time-out", "authorization failed",
-        "Unable to establish SSL connection", "Connection closed at byte",
-        "The GSI XIO driver failed to establish a secure connection.",
-        "File corruption detected", "ERROR 404", "No such file or directory",
-        "System error in open",
-        "sdget_status=7", # i.e. sdget.sh was killed by SIGINT or SIGTERM.
-        #                  This normally means that the daemon died.
-        "No data received", "Operation not permitted",
-        "Name or service not known", "ERROR 400: Bad Request",
-        "globus_ftp_client: the operation was aborted",
-        "Local file creation error"
-    ]
-    dn_errs = {}
-    errdict = { e:0 for e in known_errors }
-    known_errlines = []
-    errlines = [ l for l in sincelines if l.find('SDDMDEFA-102 Transfer failed')>0 ]
-    
-    for err in known_errors:
-        elines = [ l for l in errlines if l.find(err)>0 ]
-        for ll in elines:
-            datanode = logline_datanode(ll)
-            if datanode not in dn_errs:
-                dn_errs[datanode] = {}
-            if err in dn_errs[datanode]:
-                dn_errs[datanode][err] +=1
-            else:
-                dn_errs[datanode][err] = 1
-        errdict[err] = len(elines)
-        known_errlines += elines
-    unknown_errlines = [ l for l in errlines if l not in known_errlines ]
+known_errors = [
+    "ERROR 503: Service Unavailable", "503 Service Temporarily Unavailable",
+    "Server side credential failure", "Cannot find trusted CA certificate",
+    "Valid credentials could not be found",
+    "/var/tmp/synda/sdt/1682/.esg/credentials.pem is not a valid file",
+    "Temporary failure in name resolution", "unable to resolve host address",
+    "Connection timed out", "Connection refused", "Connection reset by peer",
+    "Bad Gateway" , "504 Gateway Time-out", "authorization failed",
+    "Unable to establish SSL connection", "Connection closed at byte",
+    "The GSI XIO driver failed to establish a secure connection.",
+    "File corruption detected", "ERROR 404", "No such file or directory",
+    "System error in open",
+    "sdget_status=7", # i.e. sdget.sh was killed by SIGINT or SIGTERM.
+    #                  This normally means that the daemon died.
+    "No data received", "Operation not permitted",
+    "Name or service not known", "ERROR 400: Bad Request",
+    "globus_ftp_client: the operation was aborted",
+    "Local file creation error"
+]
+# One regular expression matches all the known errors.  No known error overlaps another, so
+# finditer() will find every known error in a line.
+known_errors_re = re.compile( '|'.join( [ re.escape(e) for e in known_errors ] ) )
 
-    return len(known_errlines), len(unknown_errlines), errdict, dn_errs, unknown_errlines
+def new_transfer_tallies():
+    """Returns a dict of empty tallies, for classify_transfer_line() to fill in."""
+    return { 'nlines':0, 'donecount':0, 'dn_done':{},
+             'knownerr':0, 'unknownerr':0, 'errdict':{ e:0 for e in known_errors },
+             'dn_errs':{}, 'unknowns':[],
+             'fallbackcount':0, 'dn_fallback':{}, 'fb_dict':{},
+             'terrors':[], 'templates':{} }
 
-def transfer_done_counts( sincelines ):
-    """returns file transfer success ('done') counts in sincelines, a subset of transfer.log"
-    """
-    dn_done = {}
-    # this duplicates the sincelines computation in transfer_error_counts, but performance isn't
-    # critical and it simplifies coding...
-    donelines = [ l for l in sincelines if l.find('Transfer done')>0 ]
-    for ll in donelines:
+# Variable parts of an error message, which are masked to make its template.  The first
+# alternative which matches, in this order, is replaced by its name, e.g. <URL>.  Numbers which
+# follow '-' aren't masked, so that message ids such as SDDMDEFA-102 stay in the template.
+variable_tokens_re = re.compile(
+    r'(?P<URL>\b(?:https?|gsiftp|ftp)://[^\s,;()\'"]+)|'
+    r'(?P<TIME>\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d(?:[.,]\d+)?)|'
+    r'(?P<PATH>(?:/[\w.+~@%-]+)+/?)|'
+    r'(?P<HEX>\b(?:0x[0-9a-fA-F]+|(?=[0-9]*[a-fA-F])[0-9a-fA-F]{8,})\b)|'
+    r'(?P<N>(?<![-\w.])\d+(?:\.\d+)?)' )
+
+def error_template( ll ):
+    """Returns the template of a log line: the part after the time, with its variable parts
+    (urls, times, paths, hex ids, and numbers such as byte counts and pids) masked."""
+    return variable_tokens_re.sub( lambda m: '<'+m.lastgroup+'>', ll[24:].rstrip() )
+
+def add_template( ll, tallies ):
+    """Adds a line with an unknown error into tallies['templates'], a dict whose keys are
+    templates (see error_template()) and whose values are dicts: count, the number of lines;
+    first and last, the times of the first and last lines; and datanodes, {data_node: count}."""
+    template = error_template( ll )
+    time = ll[:19]
+    if template not in tallies['templates']:
+        tallies['templates'][template] = { 'count':0, 'first':time, 'last':time, 'datanodes':{} }
+    t = tallies['templates'][template]
+    t['count'] += 1
+    t['first'] = min( t['first'], time )
+    t['last'] = max( t['last'], time )
+    if ll.find('http')>0 or ll.find('gsiftp')>0:
         datanode = logline_datanode(ll)
-        if datanode not in dn_done:
-            dn_done[datanode] = 0
-        dn_done[datanode] +=1
-    return len(donelines), dn_done
-    
-def transfer_fallback_counts( sincelines ):
-    """returns file transfer fallback (i.e. try another url) counts in sincelines, a subset of
-    transfer.log
-    """
+    else:
+        datanode = 'none'
+    t['datanodes'][datanode] = t['datanodes'].get( datanode, 0 ) + 1
+
+def classify_transfer_line( ll, tallies ):
+    """Classifies one line of transfer.log and adds it into tallies, a dict from
+    new_transfer_tallies().  These are the tallies:
+    done lines: donecount, and dn_done (data_node: count)
+    error lines: knownerr, the number of known errors (a line with two known errors counts twice);
+      unknownerr, the number of error lines without a known error; errdict (error: count);
+      dn_errs (data_node: {error: count}); unknowns, the lines with unknown errors;
+      templates, the unknown errors grouped by template, see add_template()
+    fallback lines: fallbackcount; dn_fallback (data_node: count); and
+      fb_dict (data_node: {fallback data_node, or scheme if the same institution: count})
+    interesting errors, see interesting_transfer_error(): terrors, the lines.
+    all lines: nlines, the number of lines."""
     global inst, scheme
-    dn_fallback = {}
-    fb_dict = {}
-    fallbacklines = [ l for l in sincelines if l.find('Url successfully switched')>0 ]
-    for ll in fallbacklines:
+    tallies['nlines'] += 1
+    if ll.find('SDDMDEFA-102 Transfer failed')>0:
+        errs = set( [ m.group() for m in known_errors_re.finditer(ll) ] )
+        if len(errs)==0:
+            tallies['unknownerr'] += 1
+            tallies['unknowns'].append( ll )
+            add_template( ll, tallies )
+        else:
+            datanode = logline_datanode(ll)
+            dn_errs = tallies['dn_errs'].setdefault( datanode, {} )
+            for err in errs:
+                dn_errs[err] = dn_errs.get( err, 0 ) + 1
+                tallies['errdict'][err] += 1
+            tallies['knownerr'] += len(errs)
+    if ll.find('Transfer done')>0:
+        datanode = logline_datanode(ll)
+        tallies['dn_done'][datanode] = tallies['dn_done'].get( datanode, 0 ) + 1
+        tallies['donecount'] += 1
+    if ll.find('Url successfully switched')>0:
         datanode1 = logline_datanode(ll[ll.find("old_url"):])
         datanode2 = logline_datanode(ll[ll.find("new_url"):])
-        if datanode1 not in dn_fallback:
-            dn_fallback[datanode1] = 0
-        dn_fallback[datanode1] +=1
-        if datanode1 not in fb_dict:
-            fb_dict[datanode1] = {}
-        fb_to = scheme[datanode2] if inst[datanode1]==inst[datanode2] else datanode2 
-        if fb_to not in fb_dict[datanode1]:
-            fb_dict[datanode1][fb_to] = 0
-        fb_dict[datanode1][fb_to] +=1
-        
-    return len(fallbacklines), dn_fallback, fb_dict
-    
+        tallies['dn_fallback'][datanode1] = tallies['dn_fallback'].get( datanode1, 0 ) + 1
+        fb_dict = tallies['fb_dict'].setdefault( datanode1, {} )
+        fb_to = scheme[datanode2] if inst[datanode1]==inst[datanode2] else datanode2
+        fb_dict[fb_to] = fb_dict.get( fb_to, 0 ) + 1
+        tallies['fallbackcount'] += 1
+    if interesting_transfer_error( ll ):
+        tallies['terrors'].append( ll )
+
+def transfer_counts( sincelines ):
+    """Reads each line of sincelines, a subset of transfer.log, once, and returns a dict of
+    tallies of done, error, and fallback lines and of interesting errors.
+    See classify_transfer_line() for the tallies."""
+    tallies = new_transfer_tallies()
+    for ll in sincelines:
+        classify_transfer_line( ll, tallies )
+    order_transfer_tallies( tallies )
+    return tallies
+
+def order_transfer_tallies( tallies ):
+    """Rebuilds each data_node's error counts in dn_errs, inserting the errors in the order of
+    known_errors.  Dict order depends on the order of insertion, so this makes the report's
+    listing of errors the same however the counts were accumulated."""
+    dn_errs = tallies['dn_errs']
+    for dn in dn_errs:
+        dn_errs[dn] = dict( [ (err, dn_errs[dn][err]) for err in known_errors if err in dn_errs[dn] ] )
+
+def transfer_line_events( ll ):
+    """Returns a list of the events in one line of transfer.log, each a tuple (kind, datanode,
+    detail).  These are ('done', datanode, None); ('error', datanode, error) where error is a
+    known error or None for an unknown error (a line with two known errors has two events);
+    and ('fallback', datanode, the datanode it switched to)."""
+    events = []
+    if ll.find('SDDMDEFA-102 Transfer failed')>0:
+        errs = set( [ m.group() for m in known_errors_re.finditer(ll) ] )
+        datanode = logline_datanode(ll)
+        if len(errs)==0:
+            events.append( ( 'error', datanode, None ) )
+        for err in errs:
+            events.append( ( 'error', datanode, err ) )
+    if ll.find('Transfer done')>0:
+        events.append( ( 'done', logline_datanode(ll), None ) )
+    if ll.find('Url successfully switched')>0:
+        events.append( ( 'fallback', logline_datanode(ll[ll.find("old_url"):]),
+                         logline_datanode(ll[ll.find("new_url"):]) ) )
+    return events
+
+def classify_transfer_text( ll, tallies ):
+    """Adds one line of transfer.log into tallies, a dict from new_transfer_tallies(), but only
+    the tallies which need the text of the line: nlines, unknowns, templates and terrors.  Done,
+    error and fallback lines aren't taken apart; their counts by data_node come from the events
+    cache instead, see event_transfer_tallies()."""
+    tallies['nlines'] += 1
+    if ll.find('SDDMDEFA-102 Transfer failed')>0 and known_errors_re.search(ll) is None:
+        tallies['unknowns'].append( ll )
+        add_template( ll, tallies )
+    if interesting_transfer_error( ll ):
+        tallies['terrors'].append( ll )
+
+def event_transfer_tallies( starttime, tallies ):
+    """Fills in the done, error and fallback tallies of tallies (see classify_transfer_line())
+    from the transfer events cache, for the events since starttime.  The cache is first brought
+    up to date with transfer.log, see transfer_events.update_events().  The other tallies are
+    left as they are, normally from classify_transfer_text().  Returns tallies."""
+    # transfer_events imports this module, and needs NumPy; so it is imported only when used.
+    import numpy, transfer_events
+    transfer_events.update_events()
+    names = transfer_events.datanode_names()
+    events = transfer_events.events_since( transfer_events.load_events(), starttime )
+    for dn in names:
+        register_datanode( dn )
+    nnames, nerrs = len(names), len(known_errors)
+    def first_seen( keys ):
+        # Returns (key, count) for each distinct key, in the order in which they first occur.
+        # The tallies are dicts, and their order depends on the order of insertion; so this
+        # makes the report list things in the same order as classify_transfer_line() would.
+        if len(keys)==0:
+            return []
+        uniq, first, counts = numpy.unique( keys, return_index=True, return_counts=True )
+        order = numpy.argsort( first, kind='mergesort' )
+        return zip( uniq[order].tolist(), counts[order].tolist() )
+    done = events[ events['event']==transfer_events.EVENT_DONE ]
+    for dn, n in first_seen( done['datanode'] ):
+        tallies['dn_done'][names[dn]] = n
+    tallies['donecount'] = len(done)
+    errors = events[ events['event']==transfer_events.EVENT_ERROR ]
+    known = errors[ errors['error']>=0 ]
+    tallies['unknownerr'] = len(errors)-len(known)
+    tallies['knownerr'] = len(known)
+    for i, n in first_seen( known['datanode'].astype(numpy.int64)*nerrs+known['error'] ):
+        dn, err = names[i//nerrs], known_errors[i%nerrs]
+        tallies['dn_errs'].setdefault( dn, {} )[err] = n
+        tallies['errdict'][err] += n
+    fallbacks = events[ events['event']==transfer_events.EVENT_FALLBACK ]
+    tallies['fallbackcount'] = len(fallbacks)
+    for i, n in first_seen( fallbacks['datanode'].astype(numpy.int64)*nnames+fallbacks['datanode2'] ):
+        dn1, dn2 = names[i//nnames], names[i%nnames]
+        tallies['dn_fallback'][dn1] = tallies['dn_fallback'].get( dn1, 0 ) + n
+        fb_dict = tallies['fb_dict'].setdefault( dn1, {} )
+        fb_to = scheme[dn2] if inst[dn1]==inst[dn2] else dn2
+        fb_dict[fb_to] = fb_dict.get( fb_to, 0 ) + n
+    order_transfer_tallies( tallies )
+    return tallies
+
+# The transfer metrics store is a small sqlite database, MetricsDB, of counts from transfer.log.
+# Table transfer_counts has a count for each hour (e.g. '2020-10-22 11'), data_node, kind and
+# detail.  The kinds are 'done'; 'error', with the known error or 'unknown' as the detail;
+# 'fallback', with the fallback destination (see classify_transfer_line()) as the detail; and
+# 'lines', for all lines.  Table transfer_lines has the lines of unknown errors and interesting
+# errors, which the report prints.  Table log_position has the inode and first line of transfer.log
+# and the byte offset up to which it has been read.  So the store can be updated from where it was
+# left off, and any report window is an aggregate query.  Counts and lines older than
+# metrics_keep_days are deleted at each update.
+
+def metrics_setup( db=None ):
+    """Opens the transfer metrics store (by default, MetricsDB) and returns the connection.
+    Creates the tables if they don't exist."""
+    conn = sqlite3.connect( db or MetricsDB )
+    conn.text_factory = str
+    curs = conn.cursor()
+    curs.execute( "CREATE TABLE IF NOT EXISTS transfer_counts ( hour TEXT, datanode TEXT,"+
+                  " kind TEXT, detail TEXT, count INTEGER, PRIMARY KEY (hour,datanode,kind,detail) )" )
+    curs.execute( "CREATE TABLE IF NOT EXISTS transfer_lines ( time TEXT, kind TEXT, line TEXT )" )
+    curs.execute( "CREATE INDEX IF NOT EXISTS transfer_lines_time ON transfer_lines (time)" )
+    curs.execute( "CREATE TABLE IF NOT EXISTS log_position ( logfile TEXT PRIMARY KEY,"+
+                  " inode INTEGER, offset INTEGER, head TEXT )" )
+    curs.execute( "PRAGMA table_info(log_position)" )
+    if 'head' not in [ row[1] for row in curs.fetchall() ]:
+        # from before the first line was kept; it will be filled in at the next update
+        curs.execute( "ALTER TABLE log_position ADD head TEXT" )
+    conn.commit()
+    curs.close()
+    return conn
+
+def tallies2rows( hour, t ):
+    """Converts tallies (from classify_transfer_line()) for one hour into rows for the
+    transfer_counts table."""
+    rows = [ (hour, '', 'lines', '', t['nlines']) ]
+    rows += [ (hour, dn, 'done', '', n) for dn, n in t['dn_done'].items() ]
+    for dn, errs in t['dn_errs'].items():
+        rows += [ (hour, dn, 'error', err, n) for err, n in errs.items() ]
+    if t['unknownerr']>0:
+        rows.append( (hour, '', 'error', 'unknown', t['unknownerr']) )
+    for dn, fbs in t['fb_dict'].items():
+        rows += [ (hour, dn, 'fallback', fb, n) for fb, n in fbs.items() ]
+    return rows
+
+def unread_segments( logfile, position ):
+    """Returns a list of (path, byte offset) of the parts of a log file which have not yet been
+    read, and the log file's present inode and first line (see log_head()).  position is
+    (inode, offset, head) as of the last time the log file was read, or None if it has never been
+    read; head may be None or '' if it isn't known.
+    If the log file has been rotated, i.e. its inode or first line has changed, then the rest of
+    the old file is in one of its rotated segments (see log_segments()), which is recognized by
+    its inode or, if it has been compressed or copied, by its first line.  Then the segments
+    after it, if it has been rotated more than once, are read whole, and then the new file."""
+    inode = os.stat( logfile ).st_ino
+    head = log_head( logfile )
+    if position is None:
+        return [ (logfile, 0) ], inode, head
+    old_inode, offset, old_head = position
+    if old_inode==inode and os.path.getsize(logfile)>=offset and old_head in (None,'',head):
+        return [ (logfile, offset) ], inode, head
+    segments = log_segments( logfile )[:-1]
+    for i in range( len(segments)-1, -1, -1 ):
+        path = segments[i]
+        if ( old_head not in (None,'') and log_head(path)==old_head ) or\
+                ( not path.endswith('.gz') and os.stat(path).st_ino==old_inode ):
+            return [ (path, offset) ] + [ (p, 0) for p in segments[i+1:] ] + [ (logfile, 0) ],\
+                inode, head
+    sys.stderr.write( "%s was rotated, and the rest of the old file wasn't found\n" % logfile )
+    return [ (logfile, 0) ], inode, head
+
+def unread_lines( segments, reading ):
+    """Generates the lines of the segments from unread_segments(), in order.  After each line,
+    reading['offset'] is the byte offset just past it in its segment; so at the end, it is the
+    offset up to which the log file has been read.  A partly written last line of the log file
+    isn't generated; it will be read next time."""
+    for i, (path, offset) in enumerate( segments ):
+        reading['offset'] = offset
+        with open_segment( path ) as f:
+            f.seek( offset )
+            for line in f:
+                if not line.endswith('\n') and i==len(segments)-1:
+                    break
+                reading['offset'] += len(line)
+                yield line
+
+def update_metrics( conn, logfile=None, keep_days=None ):
+    """Reads the lines of transfer.log (by default, TransferLOG) which have been added since the
+    last update, and adds them into the transfer metrics store.  See unread_segments() for what
+    happens if the log file has been rotated.
+    Only complete lines are read; a partly written last line will be read next time.
+    Then counts and lines older than keep_days (by default, metrics_keep_days) are deleted."""
+    logfile = logfile or TransferLOG
+    keep_days = keep_days or metrics_keep_days
+    curs = conn.cursor()
+    curs.execute( "SELECT inode, offset, head FROM log_position WHERE logfile=?", (logfile,) )
+    segments, inode, head = unread_segments( logfile, curs.fetchone() )
+    reading = {}
+    hourly = {}   # hour: tallies
+    for line in unread_lines( segments, reading ):
+        if timestamped( line ):
+            hour = line[:13]
+            if hour not in hourly:
+                hourly[hour] = new_transfer_tallies()
+            classify_transfer_line( line, hourly[hour] )
+    cutoff = ( datetime.now()-timedelta(days=keep_days) ).strftime('%Y-%m-%d %H:%M:%S')
+    try:
+        for hour, t in hourly.items():
+            rows = tallies2rows( hour, t )
+            curs.executemany( "INSERT OR IGNORE INTO transfer_counts"+
+                              " (hour,datanode,kind,detail,count) VALUES (?,?,?,?,0)",
+                              [ r[:4] for r in rows ] )
+            curs.executemany( "UPDATE transfer_counts SET count=count+? WHERE hour=? AND"+
+                              " datanode=? AND kind=? AND detail=?",
+                              [ (r[4],)+r[:4] for r in rows ] )
+            curs.executemany( "INSERT INTO transfer_lines (time,kind,line) VALUES (?,?,?)",
+                              [ (l[:19],'unknown',l) for l in t['unknowns'] ] +
+                              [ (l[:19],'interesting',l) for l in t['terrors'] ] )
+        curs.execute( "INSERT OR REPLACE INTO log_position (logfile,inode,offset,head)"+
+                      " VALUES (?,?,?,?)", (logfile, inode, reading['offset'], head) )
+        curs.execute( "DELETE FROM transfer_counts WHERE hour<?", (cutoff[:13],) )
+        curs.execute( "DELETE FROM transfer_lines WHERE time<?", (cutoff,) )
+    except Exception as e:
+        conn.rollback()
+        raise e
+    conn.commit()
+    curs.close()
+
+def register_datanode( datanode ):
+    """Fills in inst and scheme for a data_node, e.g. http://vesg.ipsl.upmc.fr"""
+    logline_datanode( datanode+'/' )
+
+def stored_transfer_tallies( conn, starttime ):
+    """Returns tallies, as from transfer_counts(), of transfer.log since starttime.  These come
+    from the transfer metrics store, see update_metrics().  The counts are for whole hours, so
+    starttime is effectively rounded down to the hour."""
+    starttime = starttime.replace('T',' ')
+    tallies = new_transfer_tallies()
+    curs = conn.cursor()
+    curs.execute( "SELECT datanode, kind, detail, SUM(count) FROM transfer_counts WHERE hour>=?"+
+                  " GROUP BY datanode, kind, detail", (starttime[:13],) )
+    for dn, kind, detail, n in curs.fetchall():
+        if dn!='':
+            register_datanode( dn )
+        if kind=='lines':
+            tallies['nlines'] += n
+        elif kind=='done':
+            tallies['dn_done'][dn] = n
+            tallies['donecount'] += n
+        elif kind=='error' and detail=='unknown':
+            tallies['unknownerr'] += n
+        elif kind=='error':
+            tallies['dn_errs'].setdefault( dn, {} )[detail] = n
+            tallies['errdict'][detail] = tallies['errdict'].get( detail, 0 ) + n
+            tallies['knownerr'] += n
+        elif kind=='fallback':
+            tallies['fb_dict'].setdefault( dn, {} )[detail] = n
+            tallies['dn_fallback'][dn] = tallies['dn_fallback'].get( dn, 0 ) + n
+            tallies['fallbackcount'] += n
+    curs.execute( "SELECT kind, line FROM transfer_lines WHERE time>=? ORDER BY time, rowid",
+                  (starttime[:13],) )
+    for kind, line in curs.fetchall():
+        if kind=='unknown':
+            tallies['unknowns'].append( line )
+            add_template( line, tallies )
+        else:
+            tallies['terrors'].append( line )
+    curs.close()
+    order_transfer_tallies( tallies )
+    return tallies
+
 def retraction_counts( starttime ):
     """Returns the retracted.py run summaries with numFound and Nchanges.
     Also returns those exceptions which retracted.one_query() catches from status_retracted.py.
     Usually these are "database is locked" exceptions which occurred despite multiple retries."""
-    # for one day: sincelines = logsince( '/p/css03/scratch/logs/retracted.log', starttime, taillen=12000 )
-    # good enough for at least a week, maybe as much as four weeks:
-    sincelines = logsince( '/p/css03/scratch/logs/retracted.log', starttime, taillen=123000 )
+    tallies = new_retraction_tallies()
+    for l in loglines_since( RetractedLOG, starttime ):
+        classify_retraction_line( l, tallies )
+    return tallies['summaries'], tallies['exceptions']
+
+def new_retraction_tallies():
+    return { 'summaries':[], 'exceptions':[] }
+
+def classify_retraction_line( l, tallies ):
+    """Adds a line of retracted.log into tallies, a dict from new_retraction_tallies()."""
     # Normally we just want the last line.  But that won't work if there are two runs in a
     # single day, or a run hasn't finished yet.
-    summaries = [l[l.find("End of retracted.py")+21:] for l in sincelines if
-                 l.find("End of retracted.py.")>0]
-    exceptions = [l[l] for l in sincelines if l.find("Failed with exception")>0]
-    return summaries, exceptions
+    if l.find("End of retracted.py.")>0:
+        tallies['summaries'].append( l[l.find("End of retracted.py")+21:] )
+    if l.find("Failed with exception")>0:
+        tallies['exceptions'].append( l )
+
+# transfer.log ERROR lines which don't call for human attention, by what follows 'ERROR ':
+# ERROR log lines which would result in a download failure that is reported elsewhere.
+# OpenID failures if continue_on_cert_errors=True.  If it's False, then SDDMDEFA-505
+# will be logged.  Also SYDLOGON-012 which merely duplicates another report, and
+# thus can only lead to confusion.  (It occurs iff an SDMYPROX error has been logged.)
+uninteresting_errors = (
+    'SDDMDEFA-190 Download process has been killed',
+    'SDWATCHD-275 wget is stalled',
+    'SDDMDEFA-155 checksum',
+    'SDDMDEFA-002 size ',
+    'SDOPENID-200 Error occured while processing OpenID',
+    'SYDLOGON-800 Exception occured while processing openid',
+    'SDDMDEFA-502 Exception occured while retrieving certificate',
+    'SDDMDEFA-503   continue_on_cert_errors=True',
+    'SDDMDEFA-504 Ignoring exception',
+    'SYDLOGON-012 Error code=None,message=None while retrieving certificate from myproxy server'
+    )
 
 def interesting_transfer_error( line ):
     """Tests a transfer.log line for whether it calls for human attention."""
-    # Omitted: ERROR log lines which would result in a download failure that is reported elsewhere.
-    # Omitted: OpenID failures if continue_on_cert_errors=True.  If it's False, then SDDMDEFA-505
-    # will be logged.  Also omitted is SYDLOGON-012 which merely duplicates another report, and
-    # thus can only lead to confusion.
-    if line[24:29]!='ERROR':
-        return False
-    elif line[30:75]=='SDDMDEFA-190 Download process has been killed':
-        return False
-    elif line[30:58]=='SDWATCHD-275 wget is stalled':
-        return False
-    elif line[30:51]=='SDDMDEFA-155 checksum':
-        return False
-    elif line[30:48]=='SDDMDEFA-002 size ':
-        return False
-    elif line[30:80]=='SDOPENID-200 Error occured while processing OpenID':
-        return False
-    elif line[30:84]=='SYDLOGON-800 Exception occured while processing openid':
-        return False
-    elif line[30:89]=='SDDMDEFA-502 Exception occured while retrieving certificate':
-        return False
-    elif line[30:73]=='SDDMDEFA-503   continue_on_cert_errors=True':
-        return False
-    elif line[30:61]=='SDDMDEFA-504 Ignoring exception':
-        return False
-    elif line[30:120]=='SYDLOGON-012 Error code=None,message=None while retrieving certificate from myproxy server':
-        return False # This occurs iff an SDMYPROX error has been logged.
-    return True
+    return line[24:29]=='ERROR' and not line.startswith( uninteresting_errors, 30 )
 
 def interesting_transfer_errors( lines ):
     """Searches the supplied transfer.log lines for errors which call for human attention,
@@ -222,18 +627,309 @@ def interesting_discovery_errors( lines ):
             terrors.append( line )
     return terrors
 
+def new_discovery_tallies():
+    return { 'nlines':0, 'terrors':[] }
+
+def classify_discovery_line( line, tallies ):
+    """Adds a line of discovery.log into tallies, a dict from new_discovery_tallies()."""
+    tallies['nlines'] += 1
+    if line[24:29]=='ERROR':
+        tallies['terrors'].append( line )
+
+# For each kind of log: functions to make empty tallies, and to add a line into them.
+log_classifiers = {
+    'transfer':  ( new_transfer_tallies, classify_transfer_line ),
+    'transfer_text': ( new_transfer_tallies, classify_transfer_text ),
+    'discovery': ( new_discovery_tallies, classify_discovery_line ),
+    'retracted': ( new_retraction_tallies, classify_retraction_line ) }
+
+def merge_tallies( total, tallies ):
+    """Adds tallies into total.  Both are dicts of the same kind, from log_classifiers.  Numbers
+    are added; lists are appended; dicts are merged in the same way."""
+    for key, value in tallies.items():
+        if isinstance( value, dict ):
+            merge_tallies( total.setdefault( key, {} ), value )
+        elif isinstance( value, list ):
+            total.setdefault( key, [] ).extend( value )
+        else:
+            total[key] = total.get( key, 0 ) + value
+
+def merge_templates( total, templates ):
+    """Adds templates, a dict of unknown-error templates as in add_template(), into total, another
+    such dict.  Counts are added, the earlier first and later last times are kept, and the counts
+    by data_node are added."""
+    for template, t in templates.items():
+        if template not in total:
+            total[template] = { 'count':0, 'first':t['first'], 'last':t['last'], 'datanodes':{} }
+        tt = total[template]
+        tt['count'] += t['count']
+        tt['first'] = min( tt['first'], t['first'] )
+        tt['last'] = max( tt['last'], t['last'] )
+        for datanode, n in t['datanodes'].items():
+            tt['datanodes'][datanode] = tt['datanodes'].get( datanode, 0 ) + n
+
+def scan_tasks( kind, logfile, starttime, nchunks ):
+    """Divides the part of a log file since starttime into chunks, and returns a list of tasks
+    (kind, path, begin, end, starttime) for scan_range().  Each plain segment of the log file
+    (see log_segments()) is split into up to nchunks byte ranges which begin at the start of a
+    line, and are at least chunk_min bytes.  A compressed segment is one chunk."""
+    tasks = []
+    for path in segments_since( logfile, starttime ):
+        if path.endswith('.gz'):
+            tasks.append( ( kind, path, 0, None, starttime ) )
+            continue
+        begin = log_seek( path, starttime )
+        size = os.path.getsize( path )
+        step = max( (size-begin)//nchunks+1, chunk_min )
+        bounds = [begin]
+        with open( path, 'r' ) as f:
+            for b in range( begin+step, size, step ):
+                f.seek( b-1 )
+                f.readline()   # moves to the start of the first line after b-1
+                if f.tell()>bounds[-1] and f.tell()<size:
+                    bounds.append( f.tell() )
+        ends = bounds[1:] + [None]   # the last chunk goes on to the end of the file
+        tasks += [ ( kind, path, b, e, starttime ) for b, e in zip( bounds, ends ) ]
+    return tasks
+
+def scan_range( task ):
+    """Classifies the lines since starttime in a byte range of a log file, and returns their
+    tallies.  task is (kind, path, begin, end, starttime), see scan_tasks(); end may be None,
+    for the end of the file.  This is a module-level function so that a process pool can run it."""
+    kind, path, begin, end, starttime = task
+    new_tallies, classify = log_classifiers[kind]
+    starttime = starttime.replace('T',' ')[:19]
+    tallies = new_tallies()
+    with open_segment( path ) as f:
+        if begin>0:
+            f.seek( begin )
+        offset = begin
+        for line in f:
+            if end is not None and offset>=end:
+                break
+            offset += len(line)
+            if timestamped( line ) and line[:19]>=starttime:
+                classify( line, tallies )
+    return tallies
+
+def parallel_scan( starttime, processes, logs ):
+    """Scans log files since starttime in a pool of processes.  logs is a dict whose keys are
+    kinds of log (see log_classifiers) and whose values are log files, e.g.
+    { 'transfer':TransferLOG, 'discovery':DiscoveryLOG }.  The logs are split into chunks,
+    see scan_tasks(); the chunks of all the logs are scanned concurrently.
+    Returns a dict whose keys are the kinds of log and whose values are their tallies, the same
+    as if they had been scanned line by line."""
+    tasks = []
+    for kind, logfile in logs.items():
+        tasks += scan_tasks( kind, logfile, starttime, processes*4 )
+    pool = multiprocessing.Pool( processes )
+    try:
+        results = pool.map( scan_range, tasks, chunksize=1 )
+    finally:
+        pool.close()
+        pool.join()
+    totals = { kind:log_classifiers[kind][0]() for kind in logs }
+    for task, tallies in zip( tasks, results ):
+        if 'templates' in tallies:
+            merge_templates( totals[task[0]]['templates'], tallies.pop('templates') )
+        merge_tallies( totals[task[0]], tallies )   # in order, so lists are in time order
+    if 'transfer' in totals:
+        t = totals['transfer']
+        order_transfer_tallies( t )
+        # inst and scheme were filled in by the other processes, but we need them here.
+        for dn in set(t['dn_done'].keys()) | set(t['dn_errs'].keys()) | set(t['dn_fallback'].keys()):
+            register_datanode( dn )
+    return totals
+
+
+# Follow mode: read transfer.log as it is written, and keep rolling counts of events by data_node
+# and kind of event (done, fallback, or an error), for each of the time windows rolling_windows.
+# Each window's counts are kept in a ring of buckets.  A ring is a dict with the bucket width in
+# seconds, and lists of the count and epoch (time//width) of each bucket; a bucket is reused when
+# its epoch has passed out of the window.  So memory and the time per line are constant.
+rolling_windows = [ ( '5min', 300, 10 ), ( '1hour', 3600, 12 ), ( '24hour', 86400, 24 ) ]
+                  # name, window in seconds, number of buckets
+
+def new_ring( window, nbuckets ):
+    return { 'width':window//nbuckets, 'counts':[0]*nbuckets, 'epochs':[-1]*nbuckets }
+
+def ring_add( ring, t, n=1 ):
+    """Adds n to the count of a ring at time t, in seconds since 1970."""
+    epoch = int(t)//ring['width']
+    i = epoch % len(ring['counts'])
+    if ring['epochs'][i]!=epoch:
+        ring['epochs'][i] = epoch
+        ring['counts'][i] = 0
+    ring['counts'][i] += n
+
+def ring_total( ring, t ):
+    """Returns the total count of a ring in its window ending at time t."""
+    epoch = int(t)//ring['width']
+    nbuckets = len(ring['counts'])
+    return sum( [ c for c, e in zip( ring['counts'], ring['epochs'] ) if epoch-nbuckets<e<=epoch ] )
+
+line_time_cache = { 'key':None, 'value':None }   # the last conversion done by line_time()
+
+def line_time( line ):
+    """Returns the time at the start of a log line, in seconds since 1970.  The log's times are
+    local.  The conversion for the last second seen is kept in line_time_cache, since many lines
+    share it; only that one is kept."""
+    if line_time_cache['key']!=line[:19]:
+        line_time_cache['key'] = line[:19]
+        line_time_cache['value'] = time.mktime(
+            datetime.strptime( line[:19], '%Y-%m-%d %H:%M:%S' ).timetuple() )
+    return line_time_cache['value']
+
+def follow_line( line, counters ):
+    """Adds the events of one line of transfer.log into the rolling counters, a dict whose keys
+    are (datanode, kind) and whose values are lists of rings, one per rolling_windows."""
+    if not timestamped( line ):
+        return
+    t = None
+    for kind, datanode, detail in transfer_line_events( line ):
+        if kind=='error':
+            kind = detail or 'unknown error'
+        key = ( datanode, kind )
+        if key not in counters:
+            counters[key] = [ new_ring( window, nbuckets ) for name, window, nbuckets in rolling_windows ]
+        t = t or line_time( line )
+        for ring in counters[key]:
+            ring_add( ring, t )
+
+def follow_snapshot( counters, now ):
+    """Returns a compact report, as a string, of the rolling counters at time now.
+    Counters which are zero in every window are dropped, so that only active keys take memory."""
+    totals = {}   # datanode: {kind: [count in each window]}
+    for key in counters.keys():
+        counts = [ ring_total( ring, now ) for ring in counters[key] ]
+        if max(counts)==0:
+            del counters[key]
+            continue
+        totals.setdefault( key[0], {} )[key[1]] = counts
+    names = '/'.join( [ name for name, window, nbuckets in rolling_windows ] )
+    lines = [ "%s transfer counts in the last %s:" % ( datetime.fromtimestamp(now).strftime(
+        '%Y-%m-%d %H:%M:%S' ), names ) ]
+    datanodes = totals.keys()
+    for dn in datanodes:
+        register_datanode( dn )
+    datanodes.sort( key=(lambda dn: (inst[dn], dn) ) )
+    for dn in datanodes:
+        kinds = totals[dn]
+        nwindows = len(rolling_windows)
+        errors = [ sum( [ counts[i] for kind, counts in kinds.items() if kind not in
+                          ('done','fallback') ] ) for i in range(nwindows) ]
+        lines.append( "{:6.6} {:30.30} done {:>16} error {:>16} fallback {:>16}".format(
+            inst[dn], dn, '/'.join( map( str, kinds.get( 'done', [0]*nwindows ) ) ),
+            '/'.join( map( str, errors ) ),
+            '/'.join( map( str, kinds.get( 'fallback', [0]*nwindows ) ) ) ) )
+        for kind in sorted( kinds.keys() ):
+            if kind not in ('done','fallback'):
+                lines.append( "   {:30.30} {:>16}".format( kind, '/'.join( map( str, kinds[kind] ) ) ) )
+    return '\n'.join( lines )+'\n'
+
+def follow( logfile=None, interval=60, snapshot_file=None ):
+    """Follows transfer.log (by default, TransferLOG) as it is written, and every interval seconds
+    prints a snapshot of the rolling counts, see follow_snapshot(); or, if snapshot_file is
+    supplied, replaces that file with it.  This begins by reading the last 24 hours of the log,
+    to fill the rolling windows; including its rotated segments, see segments_since(), if it has
+    been rotated in that time.  The log file is read from a byte offset which is kept up to
+    date, see unread_segments(); so rotation of the log file is handled.  This doesn't return."""
+    logfile = logfile or TransferLOG
+    counters = {}
+    warmup = max( [ window for name, window, nbuckets in rolling_windows ] )
+    start = datetime.fromtimestamp( time.time()-warmup ).strftime('%Y-%m-%d %H:%M:%S')
+    for path in segments_since( logfile, start ):
+        if path!=logfile:
+            for line in segment_lines_since( path, start ):
+                follow_line( line, counters )
+    position = ( os.stat(logfile).st_ino, log_seek( logfile, start ), log_head( logfile ) )
+    next_snapshot = time.time()
+    reading = {}
+    while True:
+        segments, inode, head = unread_segments( logfile, position )
+        for line in unread_lines( segments, reading ):
+            follow_line( line, counters )
+        position = ( inode, reading['offset'], head )
+        now = time.time()
+        if now>=next_snapshot:
+            snapshot = follow_snapshot( counters, now )
+            if snapshot_file is None:
+                sys.stdout.write( snapshot+'\n' )
+                sys.stdout.flush()
+            else:
+                with open( snapshot_file+'.tmp', 'w' ) as f:
+                    f.write( snapshot )
+                os.rename( snapshot_file+'.tmp', snapshot_file )
+            next_snapshot = now+interval
+        time.sleep( min( 5, interval ) )
 
 if __name__ == '__main__':
-    if len(sys.argv)>1:
-        start_time = sys.argv[1]
+    p = argparse.ArgumentParser( description="Report on replication from Synda's logs." )
+    p.add_argument( "start_time", nargs='?', default=None, help=
+                    "report from this time, e.g. 2020-10-22T11:32; default is a week ago" )
+    p.add_argument( "--store", dest="store", action="store_true", default=False, help=
+                    "bring the transfer metrics store up to date, and report transfer.log "+
+                    "counts from it.  The start time is rounded down to the hour." )
+    p.add_argument( "--events", dest="events", action="store_true", default=False, help=
+                    "take the done, error, and fallback counts by data_node from the transfer "+
+                    "events cache (see transfer_events.py), bringing it up to date first.  "+
+                    "transfer.log is still read for the lines of unknown and interesting "+
+                    "errors.  Not used with --store." )
+    p.add_argument( "--keep_days", dest="keep_days", required=False, type=int,
+                    default=metrics_keep_days, help=
+                    "with --store, delete counts older than this many days from the store" )
+    p.add_argument( "--processes", dest="processes", required=False, type=int, default=1, help=
+                    "number of processes scanning the logs.  If >1, the logs are split into "+
+                    "chunks, and transfer.log, discovery.log, and retracted.log are scanned "+
+                    "concurrently." )
+    p.add_argument( "--follow", dest="follow", action="store_true", default=False, help=
+                    "follow transfer.log, and show rolling counts by data_node every "+
+                    "--interval seconds.  This doesn't stop." )
+    p.add_argument( "--interval", dest="interval", required=False, type=int, default=60, help=
+                    "seconds between snapshots in --follow mode" )
+    p.add_argument( "--snapshot", dest="snapshot", required=False, default=None, help=
+                    "in --follow mode, write each snapshot to this file instead of printing it" )
+    args = p.parse_args( sys.argv[1:] )
+    if args.follow:
+        follow( TransferLOG, args.interval, args.snapshot )
+    if args.start_time is not None:
+        start_time = args.start_time
     else:
         start_time = (datetime.now()-timedelta(days=start_timeN)).strftime('%Y-%m-%d %H:%m')
     print "From",start_time,':'
-    sincelines = logsince( TransferLOG, start_time, taillen=15123456 )
-    print "searching", len(sincelines), "lines of transfer.log"
-    donecount, dn_done = transfer_done_counts(sincelines)
-    knownerr, unknownerr, errdict, dn_errs, unknowns = transfer_error_counts(sincelines)
-    fallbackcount, dn_fallback, fb_dict = transfer_fallback_counts(sincelines)
+    if args.processes>1:
+        logs = { 'discovery':DiscoveryLOG, 'retracted':RetractedLOG }
+        if args.events and not args.store:
+            logs['transfer_text'] = TransferLOG
+        elif not args.store:
+            logs['transfer'] = TransferLOG
+        scans = parallel_scan( start_time, args.processes, logs )
+    if args.store:
+        mconn = metrics_setup()
+        update_metrics( mconn, keep_days=args.keep_days )
+        tallies = stored_transfer_tallies( mconn, start_time )
+        mconn.close()
+        print "searching", tallies['nlines'], "lines of transfer.log, from", MetricsDB
+    elif args.events:
+        if args.processes>1:
+            tallies = scans['transfer_text']
+        else:
+            tallies = new_transfer_tallies()
+            for line in loglines_since( TransferLOG, start_time ):
+                classify_transfer_text( line, tallies )
+        event_transfer_tallies( start_time, tallies )
+        print "searching", tallies['nlines'], "lines of transfer.log, and the transfer events cache"
+    else:
+        if args.processes>1:
+            tallies = scans['transfer']
+        else:
+            tallies = transfer_counts( loglines_since( TransferLOG, start_time ) )
+        print "searching", tallies['nlines'], "lines of transfer.log"
+    donecount, dn_done = tallies['donecount'], tallies['dn_done']
+    knownerr, unknownerr = tallies['knownerr'], tallies['unknownerr']
+    errdict, dn_errs, unknowns = tallies['errdict'], tallies['dn_errs'], tallies['unknowns']
+    fallbackcount, dn_fallback = tallies['fallbackcount'], tallies['dn_fallback']
+    fb_dict = tallies['fb_dict']
     
     print "no. done files = ", donecount
     print "no. error files =", knownerr+unknownerr
@@ -269,8 +965,16 @@ if __name__ == '__main__':
         for err in dn_errs[dn]:
             print '  ','{:30.30} {:5d}'.format(err,dn_errs[dn][err])
 #            print '   ',err,dn_errs[dn][err]
-    print "sample lines with unknown errors:"
-    pprint( unknowns[0:4] )
+    templates = tallies['templates']
+    print "unknown errors by template (count, first and last seen, top data_nodes):"
+    byfreq = sorted( templates.keys(), key=(lambda tp: -templates[tp]['count']) )
+    for tp in byfreq[:max_templates]:
+        t = templates[tp]
+        print '{:6d} {} to {} {}'.format( t['count'], t['first'], t['last'], tp )
+        dns = sorted( t['datanodes'].items(), key=(lambda dn_n: -dn_n[1]) )[:3]
+        print '       ', ', '.join( [ '%s (%s)' % dn_n for dn_n in dns ] )
+    if len(byfreq)>max_templates:
+        print "... and %s more templates" % (len(byfreq)-max_templates)
 
     print "\nfallback counts by original url and destination:"
     for dn in datanodes:
@@ -283,7 +987,10 @@ if __name__ == '__main__':
 #    pprint( fb_dict )
 
     print "\nretraction summary since %s:"%start_time
-    ret_counts, exceptions = retraction_counts(start_time)
+    if args.processes>1:
+        ret_counts, exceptions = scans['retracted']['summaries'], scans['retracted']['exceptions']
+    else:
+        ret_counts, exceptions = retraction_counts(start_time)
     for retc in ret_counts:
         # Note retc ends with a newline, print ends with another newline which we don't need.
         sys.stdout.write( retc )
@@ -291,7 +998,7 @@ if __name__ == '__main__':
     print " %s exceptions" % len(exceptions)
 
     print "\ntransfer errors:"
-    terrors = interesting_transfer_errors( sincelines )
+    terrors = tallies['terrors']
     if len(terrors)==0:
         print "None"
     else:
@@ -299,11 +1006,14 @@ if __name__ == '__main__':
             print line
 
     print "\ndiscovery errors:"
-    disclines = logsince( DiscoveryLOG, start_time, taillen=1234000 )
-    #...The last 123000 lines of discovery.log might cover a week if we're not too busy.
-    # The last 1234000 lines is safe.
-    print "searching", len(disclines), "lines"
-    terrors = interesting_discovery_errors( disclines )
+    if args.processes>1:
+        disc = scans['discovery']
+        terrors = disc['terrors']
+    else:
+        disc = { 'nlines':0 }
+        terrors = interesting_discovery_errors(
+            counted( loglines_since( DiscoveryLOG, start_time ), disc ) )
+    print "searching", disc['nlines'], "lines"
     if len(terrors)==0:
         print "None"
     else:
@@ -40,7 +40,7 @@ sqlite3 -separator ' | ' /var/lib/synda/sdt/sdt.db "SELECT data_node,COUNT(*) FR
 
 echo >> $LOGFILE
 echo transfer.log: >> $LOGFILE 2>&1
-/home/painter/scripts/reports.py $PERF_START_DATE >> $LOGFILE 2>&1
+/home/painter/scripts/reports.py --store $PERF_START_DATE >> $LOGFILE 2>&1
 
 echo >> $LOGFILE
 echo last mark_published errors: >> $LOGFILE 2>&1
@@ -18,6 +18,7 @@ import sys, pdb
 import logging
 import sqlite3
 import debug
+import version_index
 global conn, Nupdates, Nchanges
 conn = None
 
@@ -132,12 +133,9 @@ def dataset_retracted_status( dataset_fid, suffix='retracted' ):
     if len(fresults)==0:
         # We usually get datasets into the database before they are retracted and disappear.
         # Do we have this dataset at all?  Is it superceded by a later version?
-        vers = dataset_fid[-9:]
-        same_version_exists = False
-        newer_version_exists = False
         #cmd = "SELECT dataset_functional_id FROM dataset WHERE dataset_functional_id LIKE '%s%%'"\
         #      % ( dataset_fid[:-9], )
-        cmd = "SELECT path_without_version FROM dataset WHERE dataset_functional_id='%s'" %\
+        cmd = "SELECT path_without_version,version FROM dataset WHERE dataset_functional_id='%s'" %\
               dataset_fid
         try:
             curs = conn.cursor()
@@ -154,25 +152,8 @@ def dataset_retracted_status( dataset_fid, suffix='retracted' ):
         else:
             # The dataset is in the database.
             assert( len(presults)==1 ) 
-            path_without_version = presults[0]
-            cmd = "SELECT dataset_functional_id FROM dataset WHERE path_without_version='%s'" %\
-                  path_without_version
-            try:
-                curs = conn.cursor()
-                curs.execute(cmd)
-                dresults = curs.fetchall()
-            except Exception as e:
-                logging.debug("status_retracted.dataset_retracted_status() 3 saw an exception %s"
-                              %e)
-                raise e
-            finally:
-                curs.close()
-            for dfid in dresults:
-                if dfid[0]==dataset_fid:
-                    same_version_exists = True
-                if dfid[0][-9:]>vers:
-                    newer_version_exists = True
-            if same_version_exists and not newer_version_exists:
+            path_without_version, version = presults[0]
+            if not version_index.newer_exists( conn, path_without_version, version ):
                 logging.warning( "Dataset %s is retracted but there is no newer version!"
                                  % dataset_fid )
     #print "From dataset_fid",dataset_fid, "results=",fresults
@@ -232,6 +213,7 @@ def status_retracted( datasets, suffix='retracted' ):
     global Nchanges
     Nchanges = 0
     setup()
+    version_index.refresh( conn )
     logging.info( "Reading list of retracted datasets " + datasets )
     with open( datasets, 'r' ) as f:
         for line in f:
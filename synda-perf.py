@@ -11,6 +11,12 @@ from pprint import pprint
 import sqlite3
 #import debug, pdb
 import datetime
+try:
+    import transfer_events   # needs NumPy; without it there are no transfer.log event counts
+except ImportError:
+    transfer_events = None
+else:
+    import numpy
 global conn, curs
 
 def setup():
@@ -34,6 +40,8 @@ def str2time( date ):
     FMT_min = '%Y-%m-%d %H:%M'
     FMT_sec = '%Y-%m-%d %H:%M:%S'
     FMT_frac = '%Y-%m-%d %H:%M:%S.%f'
+    if isinstance( date, datetime.datetime ):
+        return date   # already converted, e.g. by perf_by_server()
     try:
         return datetime.datetime.strptime( date, FMT_frac )
     except ValueError:
@@ -112,6 +120,12 @@ def perf_data( start, stop, server, method='aggregate' ):
     # to the amount of the file's download time which is within (start,stop).
     curs.execute( cmd )
     results = curs.fetchall()
+    return perf_rows( start, stop, server, results, method )
+
+def perf_rows( start, stop, server, results, method='aggregate' ):
+    """Returns performance data, as for perf_data(), computed from results, a list of
+    (start_date, end_date, size) of the transfers.  The dates may be strings or datetime objects.
+    The server is used only by the 'synda' method."""
     sizes =  [ size for (start_date,end_date,size) in results ]
     Nfiles = len(sizes)
     totsize = sum(sizes)
@@ -161,6 +175,64 @@ def perf_data( start, stop, server, method='aggregate' ):
         retsize =  totsize/1024/1024/1024.
     return round(retrate,4), round(spf,4), round(retsize,4), round(avgsize,4), Nfiles
 
+
+def perf_by_server( start, stop, server ):
+    """Returns the performance data of perf_data() for transfers between 'start' and 'stop' with a
+    specified server (which may have % wildcards), and also separately for each url header
+    (protocol and data node, see url_hdr()) among them.  The database is queried only once, and
+    each time is converted only once, however many url headers there are.
+    Returns (data, uhs, uh_data) where data is as returned by perf_data() for the server; uhs is
+    the sorted list of url headers, as from url_hdrs(); and uh_data is a dict whose keys are the
+    url headers and whose values are as returned by perf_data() for them."""
+    # This combines the SQL commands of perf_data and url_hdrs.
+    cmd = ("SELECT url, start_date, end_date, size, status FROM file WHERE start_date>='{0}' AND " +\
+           "end_date<='{1}' AND url LIKE '{2}%' AND " +\
+           "(status='done' OR status='published') AND size IS NOT NULL").format(start, stop, server)
+    curs.execute( cmd )
+    groups = {}   # url header: list of (start_date, end_date, size)
+    done_uhs = set([])
+    allrows = []
+    for url, start_date, end_date, size, status in curs:
+        row = ( str2time(start_date), str2time(end_date), size )
+        uh = url_hdr( url )
+        groups.setdefault( uh, [] ).append( row )
+        if status=='done':
+            done_uhs.add( uh )
+        allrows.append( row )
+    data = perf_rows( start, stop, server, allrows )
+    uhs = sorted( done_uhs )
+    uh_data = {}
+    for uh in uhs:
+        # perf_data( start, stop, uh ) would select urls LIKE uh+'%'.  That includes any other url
+        # header which begins with uh (ignoring case, as LIKE does), not only uh itself.
+        rows = []
+        for guh in groups:
+            if guh.lower().startswith( uh.lower() ):
+                rows += groups[guh]
+        uh_data[uh] = perf_rows( start, stop, uh, rows )
+    return data, uhs, uh_data
+
+def event_counts( start, stop, uhs ):
+    """Returns the counts of done, error, and fallback events in transfer.log between 'start'
+    and 'stop' for each url header in uhs, as a dict whose keys are the url headers and whose
+    values are [done, errors, fallbacks].  The events come from the transfer events cache (see
+    transfer_events.py), which isn't updated here.  As in perf_by_server(), a url header includes
+    every data_node which begins with it.  Returns None if the cache isn't available."""
+    if transfer_events is None or not os.path.isfile( transfer_events.EventsFILE ):
+        return None
+    names = transfer_events.datanode_names()
+    events = transfer_events.events_since( transfer_events.load_events(), start, stop )
+    # counts[event][datanode id] for the three kinds of event
+    counts = [ numpy.bincount( events['datanode'][events['event']==ev], minlength=len(names) )
+               for ev in ( transfer_events.EVENT_DONE, transfer_events.EVENT_ERROR,
+                           transfer_events.EVENT_FALLBACK ) ]
+    uh_counts = {}
+    for uh in uhs:
+        # The cache names a GridFTP data_node without its port, e.g. gsiftp://gridftp.ipsl.upmc.fr
+        prefix = uh.replace(':2811','').lower()
+        ids = [ i for i, name in enumerate(names) if name.lower().startswith( prefix ) ]
+        uh_counts[uh] = [ int( sum( [ c[i] for i in ids ] ) ) for c in counts ]
+    return uh_counts
             
 if __name__ == '__main__':
     setup()
@@ -188,20 +260,24 @@ if __name__ == '__main__':
                 server = sys.argv[3]
             else:
                 server = '%'
-            rate,spf,size,avgsize,Nfiles = perf_data( start, stop, server )
+            data, uhs, uh_data = perf_by_server( start, stop, server )
+            rate,spf,size,avgsize,Nfiles = data
             if rate is None:
                 print "No data downloaded"
             else:
-                uhs = url_hdrs( start, stop, server )
-                uhs.sort()
                 print 'rate',rate, "MiB/s  Nfiles",Nfiles,"  size", size, "GiB", "avg size", avgsize, "MiB", uhs
                 if len(uhs)>1:
                     for uh in uhs:
-                        rate,spf,size,avgsize,Nfiles = perf_data( start, stop, uh )
+                        rate,spf,size,avgsize,Nfiles = uh_data[uh]
                         print "rate {:6.2f}".format(rate),\
                             "MiB/s  Nfiles {:5d}".format(Nfiles),\
                             "  size {:8.2f}".format(size),\
                             "GiB", "  avg size {:8.2f}".format(avgsize), "MiB", uh
+                uh_counts = event_counts( start, stop, uhs )
+                if uh_counts is not None:
+                    print "transfer.log events from", transfer_events.EventsFILE
+                    for uh in uhs:
+                        print "done {:6d}  error {:6d}  fallback {:6d} ".format( *uh_counts[uh] ), uh
 
     finish()
 
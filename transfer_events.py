@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+"""A cache of the events in transfer.log, in a compact binary form which can be loaded with NumPy.
+Each done, error, or fallback line of transfer.log becomes a record of event_dtype:
+  time      - int64, milliseconds since 1970-01-01 in the log's (local) time; so
+              events['time'].view('datetime64[ms]') gives the times as datetime64
+  datanode  - int32 id of the data_node, e.g. http://vesg.ipsl.upmc.fr; see datanode_names()
+  datanode2 - for a fallback, the id of the data_node it switched to; otherwise -1
+  event     - EVENT_DONE, EVENT_ERROR, or EVENT_FALLBACK
+  error     - for an error, its index in reports.known_errors, or -1 if it isn't a known error;
+              otherwise -1.  A line with two known errors becomes two records.
+The records are appended, in time order, to EventsFILE.  Beside it are EventsFILE.datanodes,
+which lists the data_nodes one per line (the id of a data_node is its line number, from 0);
+and EventsFILE.position, which has the inode of transfer.log, the byte offset up to which it
+has been read, and the number of records in the events file as of then; and on a second line, the
+first line of transfer.log, see reports.unread_segments().  So update_events() reads
+only the new lines of transfer.log.  It first truncates the events file to that number of records,
+so that if an earlier update was interrupted after writing some records but before writing the
+position, those records aren't repeated, and a partly written record doesn't remain.
+
+load_events() maps the records into memory without copying them, so a year of events can be
+loaded and filtered with vectorized NumPy operations, e.g.
+  events = transfer_events.load_events()
+  names = transfer_events.datanode_names()
+  week = transfer_events.events_since( events, '2021-05-03 00:00' )
+  errors = week[ week['event']==transfer_events.EVENT_ERROR ]
+  counts = numpy.bincount( errors['datanode'], minlength=len(names) )
+reports.py --events takes its done, error, and fallback counts by data_node from here, rather than
+taking apart each line of transfer.log; and synda-perf.py lists the counts for each data_node.
+"""
+
+import sys, os, pdb
+import argparse
+import numpy
+import reports
+import debug
+
+global EventsFILE
+EventsFILE = '/p/css03/scratch/publishing/transfer_events.bin'
+
+EVENT_DONE = 0
+EVENT_ERROR = 1
+EVENT_FALLBACK = 2
+event_names = [ 'done', 'error', 'fallback' ]
+
+event_dtype = numpy.dtype( [ ('time','<i8'), ('datanode','<i4'), ('datanode2','<i4'),
+                             ('event','i1'), ('error','<i2') ] )
+
+def datanode_names( events_file=None ):
+    """Returns the list of data_nodes, indexed by their ids in the events file."""
+    path = ( events_file or EventsFILE )+'.datanodes'
+    if not os.path.isfile( path ):
+        return []
+    with open( path, 'r' ) as f:
+        return [ line.rstrip('\n') for line in f ]
+
+def read_position( events_file ):
+    """Returns (inode, offset, head, count) as of the last update, or None.  inode, offset and
+    head (the first line) are of transfer.log; count is the number of records then in the events
+    file.  A position written before count was kept has only the complete records in the file,
+    so that is the count; and one written before head was kept has '' for it."""
+    path = events_file+'.position'
+    if not os.path.isfile( path ):
+        return None
+    with open( path, 'r' ) as f:
+        first, newline, head = f.read().partition('\n')
+    fields = first.split()
+    if len(fields)<3:
+        size = os.path.getsize( events_file ) if os.path.isfile( events_file ) else 0
+        fields = fields[:2] + [ size//event_dtype.itemsize ]
+    return int(fields[0]), int(fields[1]), head, int(fields[2])
+
+def write_position( events_file, inode, offset, head, count ):
+    with open( events_file+'.position.tmp', 'w' ) as f:
+        f.write( "%s %s %s\n%s" % (inode, offset, count, head) )
+    os.rename( events_file+'.position.tmp', events_file+'.position' )
+
+def line_events( line, datanode_id ):
+    """Returns a list of (datanode, datanode2, event, error) for one line of transfer.log.
+    datanode_id is a function which returns the id of a data_node."""
+    events = []
+    for kind, datanode, detail in reports.transfer_line_events( line ):
+        if kind=='error':
+            events.append( ( datanode_id(datanode), -1, EVENT_ERROR,
+                             -1 if detail is None else reports.known_errors.index(detail) ) )
+        elif kind=='done':
+            events.append( ( datanode_id(datanode), -1, EVENT_DONE, -1 ) )
+        elif kind=='fallback':
+            events.append( ( datanode_id(datanode), datanode_id(detail), EVENT_FALLBACK, -1 ) )
+    return events
+
+def update_events( logfile=None, events_file=None ):
+    """Parses the lines of transfer.log (by default, reports.TransferLOG) which have been added
+    since the last update, and appends their events to the events file.  See
+    reports.unread_segments() for what happens if the log file has been rotated.  The first
+    update reads the rotated segments of the log file too, see reports.log_segments(), so that
+    the cache begins as far back as the log does.
+    Only complete lines are read; a partly written last line will be read next time.
+    Returns the number of events appended."""
+    logfile = logfile or reports.TransferLOG
+    events_file = events_file or EventsFILE
+    position = read_position( events_file )
+    segments, inode, head = reports.unread_segments( logfile, position and position[:3] )
+    count = 0 if position is None else position[3]
+    if position is None:
+        segments = [ (path, 0) for path in reports.log_segments( logfile ) ]
+    names = datanode_names( events_file )
+    ids = { name:i for i, name in enumerate(names) }
+    def datanode_id( name ):
+        if name not in ids:
+            ids[name] = len(names)
+            names.append( name )
+        return ids[name]
+    nnames = len(names)
+
+    times = []    # e.g. '2020-10-22T11:32:12.345', for numpy to convert all at once
+    records = []  # (datanode, datanode2, event, error)
+    reading = {}
+    for line in reports.unread_lines( segments, reading ):
+        if not reports.timestamped( line ):
+            continue
+        events = line_events( line, datanode_id )
+        if len(events)>0:
+            time = line[:10]+'T'+line[11:19]+'.'+line[20:23]
+            times += [time]*len(events)
+            records += events
+
+    events = numpy.zeros( len(records), dtype=event_dtype )
+    if len(records)>0:
+        events['time'] = numpy.array( times, dtype='datetime64[ms]' ).astype(numpy.int64)
+        columns = zip( *records )
+        for field, column in zip( ('datanode','datanode2','event','error'), columns ):
+            events[field] = column
+    # The data_nodes are written first, so that every id in the events file has a name.
+    # The position is written last; if this is interrupted, the next update will repeat it,
+    # starting from the same count of records.
+    if len(names)>nnames:
+        with open( events_file+'.datanodes', 'a' ) as f:
+            f.write( ''.join( [ name+'\n' for name in names[nnames:] ] ) )
+    with open( events_file, 'ab' ) as f:
+        f.truncate( count*event_dtype.itemsize )
+        events.tofile( f )
+    write_position( events_file, inode, reading['offset'], head, count+len(events) )
+    return len(events)
+
+def load_events( events_file=None ):
+    """Returns all the events in the events file, as a read-only memory-mapped array of
+    event_dtype.  Nothing is read until it is used."""
+    events_file = events_file or EventsFILE
+    if not os.path.isfile( events_file ) or os.path.getsize( events_file )==0:
+        return numpy.zeros( 0, dtype=event_dtype )
+    return numpy.memmap( events_file, dtype=event_dtype, mode='r' )
+
+def to_ms( time ):
+    """Converts a time such as "2020-10-22 11:32:12" or "2020-10-22T11:32" to the units of
+    event_dtype['time']."""
+    return numpy.datetime64( time.replace(' ','T'), 'ms' ).astype(numpy.int64)
+
+def events_since( events, starttime, endtime=None ):
+    """Returns the events from starttime (inclusive) to endtime (exclusive; default is no limit).
+    Because the events are in time order, this is a binary search, and the result is a view of
+    events, not a copy."""
+    first = numpy.searchsorted( events['time'], to_ms(starttime), side='left' )
+    if endtime is None:
+        return events[first:]
+    last = numpy.searchsorted( events['time'], to_ms(endtime), side='left' )
+    return events[first:last]
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(
+        description="Update the cache of transfer.log events, and summarize events by data_node." )
+    p.add_argument( "start_time", nargs='?', default=None, help=
+                    "summarize events from this time, e.g. 2020-10-22T11:32" )
+    p.add_argument( "--no_update", dest="update", action="store_false", default=True, help=
+                    "don't read transfer.log, just summarize the events already cached" )
+    args = p.parse_args( sys.argv[1:] )
+
+    if args.update:
+        print "added", update_events(), "events to", EventsFILE
+    if args.start_time is not None:
+        names = datanode_names()
+        events = events_since( load_events(), args.start_time )
+        print "events since", args.start_time, ':', len(events)
+        counts = [ numpy.bincount( events['datanode'][events['event']==ev], minlength=len(names) )
+                   for ev in range(len(event_names)) ]
+        print '{:40.40} {:>7} {:>7} {:>7}'.format( 'data_node', *event_names )
+        for i in numpy.argsort( -counts[EVENT_DONE], kind='mergesort' ):
+            print '{:40.40} {:7d} {:7d} {:7d}'.format( names[i], *[ c[i] for c in counts ] )
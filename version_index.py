@@ -0,0 +1,71 @@
+"""An in-memory index of the versions of each dataset in a Synda database.
+It maps path_without_version to a sorted tuple of the versions found in the dataset table, so that
+questions like "is this the latest version?" or "is there a newer version?" can be answered
+without any SQL per dataset.  This is used by mark_published.py and status_retracted.py.
+
+The index is built by one pass over the dataset table, and is refreshed incrementally: a refresh
+reads only those datasets whose dataset_id is larger than any seen before.  A caller should
+refresh at the start of each run (e.g. each mapfiles tarball), so that versions which Synda
+added since the last run will be known; a path or version which is missing from the index also
+causes a refresh.  Datasets which are deleted from the database are not removed from the index,
+but Synda rarely deletes datasets."""
+
+import logging
+global versions, max_dataset_id
+
+versions = {}       # path_without_version -> sorted tuple of versions
+max_dataset_id = 0  # the largest dataset_id which has been read into the index
+
+def refresh( conn ):
+    """Reads any datasets which were added since the last refresh (for the first call, all
+    datasets) into the index.  conn is an open connection to the Synda database.
+    Returns the number of datasets read."""
+    global versions, max_dataset_id
+    cmd = "SELECT dataset_id, path_without_version, version FROM dataset WHERE dataset_id>?"
+    nread = 0
+    new_max = max_dataset_id
+    try:
+        curs = conn.cursor()
+        curs.execute( cmd, (max_dataset_id,) )
+        for dataset_id, path_without_version, version in curs:
+            nread += 1
+            new_max = max( new_max, dataset_id )
+            if path_without_version is None or version is None:
+                continue
+            version = intern( str(version) )  # many datasets share a version string
+            vers = versions.get( path_without_version )
+            if vers is None:
+                versions[path_without_version] = (version,)
+            elif version not in vers:
+                versions[path_without_version] = tuple( sorted( vers + (version,) ) )
+    except Exception as e:
+        logging.debug( "version_index.refresh() saw an exception %s" %e )
+        raise e
+    finally:
+        curs.close()
+    max_dataset_id = new_max
+    logging.debug( "version_index.refresh() read %s datasets, max_dataset_id=%s" %
+                   (nread,max_dataset_id) )
+    return nread
+
+def versions_of( conn, path_without_version, version=None ):
+    """Returns the sorted tuple of versions of the dataset path_without_version, or an empty tuple
+    if there are none.  If the path, or the optional version, is not yet in the index, the index
+    will be refreshed first.  Otherwise a newer version is known only if the index has been
+    refreshed since it was added, see refresh()."""
+    global versions
+    vers = versions.get( path_without_version )
+    if vers is None or ( version is not None and version not in vers ):
+        refresh( conn )
+        vers = versions.get( path_without_version, () )
+    return vers
+
+def is_latest( conn, path_without_version, version ):
+    """Returns True iff version is the latest version of the dataset path_without_version."""
+    vers = versions_of( conn, path_without_version, version )
+    return len(vers)>0 and version==vers[-1]
+
+def newer_exists( conn, path_without_version, version ):
+    """Returns True iff the dataset path_without_version has a version newer than version."""
+    vers = versions_of( conn, path_without_version, version )
+    return len(vers)>0 and vers[-1]>version